@@ -23,19 +23,49 @@
 #
 
 import os
+import re
 import sys
 import stat
+import time
+import select
 import struct
 import socket
+import threading
+import hashlib
+import tarfile
+from array import array
 from cStringIO import StringIO
+from itertools import islice, izip
 from contextlib import closing
 from contextlib import contextmanager
-from collections import namedtuple
+from collections import namedtuple, deque
 
-from android.utils import AdbError, ProtocolError
+from android.utils import AdbError, ProtocolError, shell_quote
+from android import trace
 
-ADB_PORT = 5037
+# Optional, for compressed transfers with the v2 sync protocol
+try: import zstandard
+except ImportError: zstandard = None
+try: import lz4.frame as lz4_frame
+except ImportError: lz4_frame = None
+try: import brotli
+except ImportError: brotli = None
+
+ADB_HOST = 'localhost'
+ADB_PORT = int(os.environ.get('ANDROID_ADB_SERVER_PORT', 5037))
 SYNC_DATA_MAX = (64*1024)       # hardcoded in file_sync_service.h
+PUSH_WINDOW = 32                # max pushes awaiting a status in sync_push_many
+SHELL_CMD_MAX = 4000            # older adbd limits the 'shell:' request to MAX_PAYLOAD (4096)
+DELTA_BLOCK_SIZE = 1024*1024    # granularity of sync_patch
+BUNDLE_SIZE = 4*1024*1024       # default max size of a sync_push_bundle
+MAX_STREAMS = 16                # default cap on open sync connections per device
+POOL_MAX_IDLE = 4               # idle sync connections (and shell sessions) kept per device
+POOL_PING_AFTER = 5.0           # idle connections older than this get a STAT before reuse
+POOL_IDLE_TIMEOUT = 60.0        # ...and older than this are just dropped
+SYNC_COMPRESSION = 'any'        # default AdbDevice.compression: 'any', a codec name, or None
+RESUME_SEGMENT = 64*1024*1024   # most of a sync_push_resumable that a disconnect can lose
+RESUME_MIN_SIZE = 16*1024*1024  # partial pulls smaller than this aren't kept
+RESUME_PART = '.rsync-part-'    # see resume_part_name()
 
 # I don't know what "adb get-state" reports for the other states, so I'm
 # leaving them undefined for now.
@@ -47,23 +77,148 @@ CS_BOOTLOADER = 'bootloader'
 # Protocol helpers
 # ----------------------------------------------------------------------
 
+class AdbSocket(object):
+    """A connection to the adb server, with a receive buffer in front of it.
+
+    Reads pull big chunks into one reusable bytearray with recv_into, and the
+    protocol messages are parsed straight out of it, so a stream of small
+    messages (like a LIST reply) doesn't cost a recv() per field.  Everything
+    else is passed through to the real socket."""
+    RECV_SIZE = 256*1024
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._buf = bytearray(self.RECV_SIZE)
+        self._view = memoryview(self._buf)
+        self._start = self._end = 0     # buffered, unconsumed data is _buf[_start:_end]
+        self._sent = False              # sent something we haven't waited on yet
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def sendall(self, data):
+        self._sent = True
+        trace.count('bytes_sent', len(data))
+        self.sock.sendall(data)
+
+    def _waiting(self):
+        """About to block in recv; if that's for a reply, it's a round trip."""
+        if self._sent:
+            self._sent = False
+            trace.count('round_trips')
+
+    def _fill(self, size):
+        """Make sure at least *size* (<= RECV_SIZE) bytes are buffered."""
+        avail = self._end - self._start
+        if avail >= size:
+            return
+        if self._start + size > len(self._buf):
+            self._buf[:avail] = self._buf[self._start:self._end]
+            self._start, self._end = 0, avail
+        while self._end - self._start < size:
+            self._waiting()
+            n = self.sock.recv_into(self._view[self._end:])
+            if n == 0:
+                raise AdbError("Connection closed unexpectedly")
+            trace.count('bytes_recv', n)
+            self._end += n
+
+    def _take(self, size):
+        """Consume *size* buffered bytes; return the offset they start at."""
+        start = self._start
+        self._start += size
+        if self._start == self._end:
+            self._start = self._end = 0
+        return start
+
+    def recv(self, size):
+        if self._start == self._end:
+            self._waiting()
+            data = self.sock.recv(size)
+            trace.count('bytes_recv', len(data))
+            return data
+        size = min(size, self._end - self._start)
+        start = self._take(size)
+        return self._view[start:start+size].tobytes()
+
+    def recvall(self, size):
+        """Receive exactly *size* bytes."""
+        if size > len(self._buf):
+            return _recvall_unbuffered(self, size)
+        self._fill(size)
+        start = self._take(size)
+        return self._view[start:start+size].tobytes()
+
+    def recv_struct(self, st):
+        """Receive and unpack a struct.Struct."""
+        self._fill(st.size)
+        return st.unpack_from(self._buf, self._take(st.size))
+
+    def recv_to(self, outf, size):
+        """Receive exactly *size* bytes and write them to *outf*.  Real files
+        are written straight from the buffer; anything else gets a string,
+        since a pure-Python writer would store a memoryview's repr."""
+        as_view = isinstance(outf, file)
+        while size > 0:
+            self._fill(min(size, len(self._buf)))
+            n = min(size, self._end - self._start)
+            start = self._take(n)
+            data = self._view[start:start+n]
+            outf.write(data if as_view else data.tobytes())
+            size -= n
+
 def _recvall(sock, size):
+    recvall = getattr(sock, 'recvall', None)
+    if recvall is not None:
+        return recvall(size)
+    return _recvall_unbuffered(sock, size)
+
+def _recvall_unbuffered(sock, size):
     datas, remain = [], size
     while remain > 0:
         data = sock.recv(remain)
+        if data == '':
+            raise AdbError("Connection closed unexpectedly")
         remain -= len(data)
         datas.append(data)
     return ''.join(datas)
 
+def _recv_struct(sock, st):
+    """Receive and unpack the struct.Struct *st*."""
+    recv_struct = getattr(sock, 'recv_struct', None)
+    if recv_struct is not None:
+        return recv_struct(st)
+    return st.unpack(_recvall(sock, st.size))
+
+# "<digest>  <path>", as printed by md5sum, sha1sum and friends
+_hash_line_re = re.compile(r'^([0-9a-fA-F]{32,}) [ *](.*)$')
+
+# "<hex mode> <size> <mtime> ./<path>", as printed by list_tree()'s find; "." is the root
+_stat_line_re = re.compile(r'^([0-9a-fA-F]+) (\d+) (-?\d+) \.(/.*)?$')
+
+def _chunk_args(args, limit):
+    """Split *args* into lists that each fit in *limit* chars when joined with spaces.
+    An arg that is too long on its own gets a list to itself."""
+    chunk, size = [], 0
+    for arg in args:
+        if chunk and size + 1 + len(arg) > limit:
+            yield chunk
+            chunk, size = [], 0
+        size += len(arg) + (1 if chunk else 0)
+        chunk.append(arg)
+    if chunk:
+        yield chunk
+
 def adb_connect():
-  """Return a tcp socket.  No handshaking is done.
+  """Return a tcp socket (wrapped in an AdbSocket).  No handshaking is done.
   Raise AdbError if server not reachable."""
   try:
       sock = socket.socket()
-      sock.connect(("localhost", 5037))
+      sock.connect((ADB_HOST, ADB_PORT))
   except socket.error:
       raise AdbError("Cannot contact server; try 'adb start-server'")
-  return sock
+  trace.count('connections')
+  return AdbSocket(sock)
 
 def adb_send_command(sock, cmd):
     """Wrap envelope around *cmd*, send, receive ack.
@@ -144,6 +299,156 @@ def adb_kill():
     sock = adb_connect_and_send("host:kill")
     sock.close()
 
+# ----------------------------------------------------------------------
+# Connection pool
+# ----------------------------------------------------------------------
+
+class _ShellSession(object):
+    """A long-running 'exec:sh' that commands are fed to one at a time,
+    so they don't each need a connection of their own."""
+    def __init__(self, device):
+        self.sock = device.connect_and_send('exec:sh')
+        self.end = '\n__adb_py_%s__\n' % os.urandom(8).encode('hex')
+
+    def run(self, cmd):
+        """Run *cmd* in a subshell, with no stdin, and return its output (and stderr)."""
+        self.sock.sendall('(%s\n) </dev/null 2>&1; echo "%s"\n' % (cmd, self.end[:-1]))
+        datas, tail = [], ''
+        while True:
+            data = self.sock.recv(65536)
+            if data == '':
+                raise AdbError("Connection closed unexpectedly")
+            datas.append(data)
+            tail = (tail + data)[-len(self.end):]
+            if tail == self.end:
+                break
+        return ''.join(datas)[:-len(self.end)]
+
+    def close(self):
+        try: self.sock.close()
+        except socket.error: pass
+
+
+class _ConnectionPool(object):
+    """Idle sync connections and shell sessions for one device, ready for reuse.
+    Connections are health-checked as they're handed out.  Safe to share
+    between threads."""
+    def __init__(self, device, max_streams=MAX_STREAMS, max_idle=POOL_MAX_IDLE):
+        self.device = device
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle_sync = []     # (sock, time it went idle)
+        self.idle_shell = []
+        self.no_shell_session = False
+        self.max_streams = max_streams
+        self.streams = None
+        if max_streams:
+            self.streams = threading.BoundedSemaphore(max_streams)
+
+    def _healthy(self, sock, t_idle):
+        """Return True if idle sync connection *sock* can still be used."""
+        idle = time.time() - t_idle
+        if idle > POOL_IDLE_TIMEOUT:
+            return False
+        # Nothing should arrive on an idle connection, except maybe EOF
+        if getattr(sock, '_start', 0) != getattr(sock, '_end', 0):
+            return False
+        try:
+            if select.select([sock], [], [], 0)[0]:
+                return False
+            if idle > POOL_PING_AFTER:
+                sync_send_req(sock, 'STAT', '/')
+                sync_recv_stat(sock)
+        except (socket.error, select.error, AdbError):
+            return False
+        return True
+
+    def _close_sync(self, sock):
+        try: sync_send_req(sock, 'QUIT', '')
+        except socket.error: pass
+        try: sock.close()
+        except socket.error: pass
+
+    def get_sync(self):
+        """Return a sync connection, waiting if the device already has max_streams open."""
+        if self.streams is not None:
+            self.streams.acquire()
+        try:
+            while True:
+                with self.lock:
+                    if not self.idle_sync: break
+                    sock, t_idle = self.idle_sync.pop()
+                if self._healthy(sock, t_idle):
+                    return self._ready(sock)
+                self._close_sync(sock)
+            return self._ready(self.device.connect_and_send('sync:'))
+        except:
+            if self.streams is not None:
+                self.streams.release()
+            raise
+
+    def _ready(self, sock):
+        # Tell the sync_* functions what they may use on this connection
+        sock.features = self.device.features()
+        sock.codec = self.device.sync_codec()
+        return sock
+
+    def put_sync(self, sock, reusable):
+        """Hand back a connection from get_sync.  Unless *reusable*, it's closed."""
+        try:
+            if reusable:
+                with self.lock:
+                    if len(self.idle_sync) < self.max_idle:
+                        self.idle_sync.append((sock, time.time()))
+                        return
+            self._close_sync(sock)
+        finally:
+            if self.streams is not None:
+                self.streams.release()
+
+    def shell(self, cmd):
+        """Run *cmd* in a pooled shell session.  Returns its output, or None if
+        this device can't do shell sessions."""
+        session = None
+        with self.lock:
+            if self.no_shell_session:
+                return None
+            while self.idle_shell and session is None:
+                session = self.idle_shell.pop()
+                try: dead = select.select([session.sock], [], [], 0)[0]
+                except (socket.error, select.error): dead = True
+                if dead:
+                    session.close()
+                    session = None
+        if session is None:
+            try:
+                session = _ShellSession(self.device)
+            except AdbError:
+                self.no_shell_session = True    # no exec: on older devices
+                return None
+        try:
+            out = session.run(cmd)
+        except:
+            session.close()
+            raise
+        with self.lock:
+            if len(self.idle_shell) < self.max_idle:
+                self.idle_shell.append(session)
+                session = None
+        if session is not None:
+            session.close()
+        return out
+
+    def close(self):
+        """Close all the idle connections."""
+        with self.lock:
+            idle_sync, self.idle_sync = self.idle_sync, []
+            idle_shell, self.idle_shell = self.idle_shell, []
+        for (sock, t_idle) in idle_sync:
+            self._close_sync(sock)
+        for session in idle_shell:
+            session.close()
+
 # ----------------------------------------------------------------------
 # AdbDevice
 # ----------------------------------------------------------------------
@@ -155,6 +460,9 @@ class AdbDevice(object):
         self.state = state      # CS_OFFLINE, CS_BOOTLOADER, or CS_DEVICE
         self.devpath = devpath  # also called "qualifier" by adb help
         self.notes = notes
+        self.pool = _ConnectionPool(self)
+        self.no_list_tree = False       # set once list_tree() finds it can't work here
+        self.compression = SYNC_COMPRESSION     # see sync_codec()
 
     def __str__(self):
         return "<AdbDevice: %s %s (%s)>" % (self.serial, self.devpath, self.state)
@@ -174,6 +482,34 @@ class AdbDevice(object):
         adb_send_command(sock, cmd)
         return sock
 
+    def features(self):
+        """Return the set of features the device's adbd supports, as reported
+        by the adb server (host:features).  Empty if the server is too old to say."""
+        try:
+            return self._features
+        except AttributeError:
+            pass
+        try:
+            reply = adb_connect_and_send_withret("host-serial:%s:features" % self.serial)
+        except AdbError:
+            reply = ''
+        self._features = frozenset(f for f in reply.strip().split(',') if f)
+        return self._features
+
+    def sync_codec(self):
+        """Return the SyncCodec to compress SND2/RCV2 data with, or None.
+        *self.compression* is 'any' for the best one both ends support, a codec
+        name to use only that one, or None for no compression."""
+        if not self.compression:
+            return None
+        features = self.features()
+        if 'sendrecv_v2' not in features:
+            return None
+        for codec in SYNC_CODECS:
+            if self.compression in ('any', codec.name) and codec.feature in features:
+                return codec
+        return None
+
     def get_state(self):
         """Refresh self.state."""
         self.state = adb_connect_and_send_withret("host-serial:%s:get-state" % self.serial)
@@ -188,10 +524,20 @@ class AdbDevice(object):
         self.state = CS_DEVICE
 
     def simple_shell(self, cmd):
+        """Run *cmd* in a remote shell and return its output.
+        Uses a pooled shell session where the device supports it."""
+        trace.count('shell_commands')
+        out = self.pool.shell(cmd)
+        if out is not None:
+            return out
         outf = StringIO()
         self.shell(cmd, outf)
         return outf.getvalue()
 
+    def close(self):
+        """Close any idle connections this device is holding on to."""
+        self.pool.close()
+
     def shell(self, cmd, outf):
         """Run *cmd* in a remote shell. Result is written to outf."""
         sock = self.connect_and_send('shell:'+cmd)
@@ -200,6 +546,50 @@ class AdbDevice(object):
             if data == '': break
             outf.write(data)
 
+    def remove(self, paths, recursive=False):
+        """rm all of *paths*, with as many per shell as will fit.
+        Returns the list of paths that could not be removed."""
+        marker = 'rm failed: '
+        template = 'for f in %%s; do %s "$f" || echo "%s$f"; done' % (
+            'rm -r' if recursive else 'rm', marker)
+        failed = []
+        quoted = [shell_quote(path) for path in paths]
+        for chunk in _chunk_args(quoted, SHELL_CMD_MAX - len(template)):
+            for line in self.simple_shell(template % ' '.join(chunk)).split('\n'):
+                line = line.rstrip('\r')
+                if line.startswith(marker):
+                    failed.append(line[len(marker):])
+        return failed
+
+    def file_hashes(self, paths, command='md5sum'):
+        """Hash all of *paths* on the device, with as many per shell as will fit.
+        Returns a dict mapping path -> hex digest.  Paths that could not be
+        hashed (missing, unreadable, no *command* on this device) are left out."""
+        hashes = {}
+        template = '%s %%s 2>/dev/null' % command
+        quoted = [shell_quote(path) for path in paths]
+        for chunk in _chunk_args(quoted, SHELL_CMD_MAX - len(template)):
+            for line in self.simple_shell(template % ' '.join(chunk)).split('\n'):
+                m = _hash_line_re.match(line.rstrip('\r'))
+                if m is not None:
+                    hashes[m.group(2)] = m.group(1).lower()
+        return hashes
+
+    def block_hashes(self, path, block_size, count):
+        """md5 the first *count* blocks of *path* on the device.
+        Returns a list of hex digests, or [] if that couldn't be done."""
+        script = ('i=0; while [ $i -lt %d ]; do '
+                  'dd if=%s bs=%d skip=$i count=1 2>/dev/null | md5sum; '
+                  'i=$((i+1)); done') % (count, shell_quote(path), block_size)
+        hashes = []
+        for line in self.simple_shell(script).split('\n'):
+            m = _hash_line_re.match(line.rstrip('\r'))
+            if m is not None:
+                hashes.append(m.group(1).lower())
+        if len(hashes) != count:
+            return []
+        return hashes
+
     def lolcat(self, outf, tags=""):
         """adb lolcat"""
         self.shell('export ANDROID_LOG_TAGS="%s" ; exec logcat' % (tags,), outf)
@@ -221,9 +611,72 @@ class AdbDevice(object):
             for tup in android_walk(sock, root+'/'+subdir):
                 yield tup
 
-    def walk(self, root):
+    def list_tree(self, root, prunes=()):
+        """List everything under *root* with one shell command, instead of a
+        LIST round trip per directory.  Returns a dict mapping each directory
+        to its (dirs, files), as for tree_walk(), with *files* a DirentList,
+        or None if that didn't work this time.  If this device can't do it at
+        all (no find -exec, or no stat -c, as on older toolbox builds), it
+        isn't tried again.
+
+        *prunes* are (test, pattern, dir_only) for find to leave out, along
+        with everything under them, as from Filter.find_prunes()."""
+        if self.no_list_tree:
+            return None
+        skip = ''
+        if prunes:
+            skip = '\\( %s \\) -prune -o ' % ' -o '.join(
+                '%s%s %s' % ('-type d ' if dir_only else '', test, shell_quote(pattern))
+                for (test, pattern, dir_only) in prunes)
+        cmd = ("cd %s 2>/dev/null || { echo missing; exit 0; }; "
+               "find . %s-exec stat -c '%%f %%s %%Y %%n' {} + 2>/dev/null") % (shell_quote(root), skip)
+        out = self.simple_shell(cmd)
+        if out.strip() == 'missing':
+            return { root: ([], []) }
+        if prunes and not out.strip():
+            # Maybe this find has no -iname or -ipath; the rest may still work
+            return self.list_tree(root)
+        tree = { root: ([], DirentList()) }
+        modes = {}              # the same few modes over and over; keep one of each
+        parent = None           # entries come a directory at a time, mostly
+        n = 0
+        try:
+            for (mode, size, mtime, path) in _stat_entries(out):
+                n += 1
+                if path is None:
+                    continue    # the root
+                mode = modes.get(mode) or modes.setdefault(mode, int(mode, 16))
+                (p, name) = (root + path).rsplit('/', 1)
+                if p != parent:
+                    parent = p
+                    (dirs, files) = tree.get(p) or tree.setdefault(p, ([], DirentList()))
+                if stat.S_ISDIR(mode):
+                    dirs.append( dirent(mode, int(size), int(mtime), name) )
+                    tree.setdefault(root + path, ([], DirentList()))
+                elif stat.S_ISREG(mode):
+                    files.append( (mode, int(size), int(mtime), name) )
+        except ValueError:
+            if not n:
+                # Not find and stat output at all; this device can't
+                self.no_list_tree = True
+            return None
+        if not n:
+            # No output: find or stat failed outright
+            self.no_list_tree = True
+            return None
+        return tree
+
+    def walk(self, root, prunes=()):
         """Like os.walk.  Yields (root, dirs, files) tuples.
-        *dirs* and *files* are lists of (mode, size, mtime, name) tuples."""
+        *dirs* and *files* are lists of (mode, size, mtime, name) tuples.
+        The tree is listed up front by list_tree() where the device can do
+        that, and otherwise a directory at a time with LIST.  *prunes* are
+        passed on to list_tree(), and may or may not be left out."""
+        tree = self.list_tree(root, prunes)
+        if tree is not None:
+            for x in tree_walk(root, tree, consume=True):
+                yield x
+            return
         with self.sync_transaction() as sock:
             for x in sync_walk(sock, root):
                 yield x
@@ -245,10 +698,8 @@ df_test_mtime"""
 
     def get_build_props(self):
         """Return /system/build.prop as a dict."""
-        outf = StringIO()
-        self.shell('cat /system/build.prop', outf)
         props = {}
-        for line in outf.getvalue().split('\n'):
+        for line in self.simple_shell('cat /system/build.prop').split('\n'):
             if '=' not in line: continue
             try: k,v = line.strip().split('=',1)
             except ValueError: continue
@@ -259,30 +710,32 @@ df_test_mtime"""
 
     @contextmanager
     def sync_transaction(self):
-        """Returns a socket you can use with all the sync_* methods, cleaning it up when you're done."""
-        sock = self.connect_and_send('sync:')
+        """Returns a socket you can use with all the sync_* methods, cleaning it up when you're done.
+        The socket comes from self.pool, and goes back there unless something
+        went wrong.  Blocks while the device has MAX_STREAMS of them open."""
+        sock = self.pool.get_sync()
+        ok = False
         try:
             yield sock
+            ok = True
         finally:
-            try: sync_send_req(sock, 'QUIT', '')
-            except socket.error: pass
-            try: sock.close()
-            except socket.error: pass
+            self.pool.put_sync(sock, ok)
 
     def sync_iterlist(self, sock, path):
         """List directory on device.
         Yields (mode, size, mtime, name)"""
-        sync_send_req(sock, 'LIST', path)
-        while True:
-            (id,mode,size,mtime,name) = sync_recv_dirent(sock)
-            if id == 'DONE': break
-            yield (mode, size, mtime, name)
+        return _sync_iterlist(sock, path)
 
     def sync_stat(self, sock, remote_file):
         """Helper: return st_mode, st_size, st_mtime.
-        *sock* must be connected and in "stat mode"."""
-        sync_send_req(sock, 'STAT', remote_file)
-        _, mode, size, mtime = sync_recv_stat(sock)
+        *sock* must be connected and in "stat mode".
+        st_mode is 0 if there's no such file."""
+        if 'stat_v2' in getattr(sock, 'features', ()):
+            sync_send_req(sock, 'LST2', remote_file)
+            _, mode, size, mtime = sync_recv_stat2(sock)
+        else:
+            sync_send_req(sock, 'STAT', remote_file)
+            _, mode, size, mtime = sync_recv_stat(sock)
         return (mode, size, mtime)
 
     def sync_push(self, sock, local_file, remote_file):
@@ -292,37 +745,266 @@ df_test_mtime"""
         mode = self.sync_stat(sock, remote_file)[0]
         if mode != 0 and stat.S_ISDIR(mode):
             raise AdbError("Cannot push onto %s: is S_ISDIR" % remote_file)
+        _sync_send_file(sock, local_file, remote_file, mode)
+        sync_recv_status(sock)
 
-        # Handle case of file-like object.
-        if hasattr(local_file, 'read'):
-            mode, mtime = 0644, 0
-            sync_send_req(sock, 'SEND', "%s,%d" % (remote_file, mode))
-            while True:
-                data = local_file.read(SYNC_DATA_MAX)
-                if data == '': break
-                sync_send_data_data(sock, data)
-            sync_send_data_done(sock, mtime)
-            sync_recv_status(sock)
-            return
+    def sync_push_many(self, sock, items, window=PUSH_WINDOW):
+        """Pipelined sync_push, for pushing lots of files without waiting on
+        the device between each one.
+
+        *items* is an iterable of (local_file, remote_file, ...) tuples; extra
+        elements are ignored.  Each tuple is yielded back once the device has
+        acknowledged the push.  The STATs for the next *window* files go out
+        before the current window's data, and statuses are matched back to files
+        in the order they were sent.  Raises AdbError naming the file that failed."""
+        items = iter(items)
+        # What the device will send back next, in order: ('stat'|'push', item, time sent)
+        pending = deque()
+
+        def send_stats(batch):
+            for item in batch:
+                sync_send_req(sock, 'STAT', item[1])
+                pending.append(('stat', item, None))
+
+        batch = list(islice(items, window))
+        send_stats(batch)
+        while batch:
+            # Collect this batch's STAT replies.  Pushes from the previous batch
+            # are queued ahead of them, so retire those along the way.
+            modes = []
+            while len(modes) < len(batch):
+                kind, item, t_sent = pending.popleft()
+                if kind == 'stat':
+                    modes.append(sync_recv_stat(sock)[1])
+                else:
+                    _sync_recv_push_status(sock, item[1])
+                    trace.sample('push', t_sent, item[1])
+                    yield item
+            for (item, mode) in zip(batch, modes):
+                if mode != 0 and stat.S_ISDIR(mode):
+                    raise AdbError("Cannot push onto %s: is S_ISDIR" % item[1])
+
+            next_batch = list(islice(items, window))
+            try:
+                send_stats(next_batch)
+                for (item, mode) in zip(batch, modes):
+                    t_sent = time.time()
+                    _sync_send_file(sock, item[0], item[1], mode)
+                    pending.append(('push', item, t_sent))
+            except socket.error:
+                # The device hangs up after a FAIL, so our send is the first to notice.
+                # Look for the FAIL so the error names the right file.
+                exc_info = sys.exc_info()
+                try:
+                    while pending:
+                        kind, item, t_sent = pending.popleft()
+                        if kind == 'stat': sync_recv_stat(sock)
+                        else: _sync_recv_push_status(sock, item[1])
+                except socket.error:
+                    pass
+                raise exc_info[0], exc_info[1], exc_info[2]
+            batch = next_batch
+
+        while pending:
+            kind, item, t_sent = pending.popleft()
+            _sync_recv_push_status(sock, item[1])
+            trace.sample('push', t_sent, item[1])
+            yield item
+
+    def sync_patch(self, sock, local_file, remote_file, block_size=DELTA_BLOCK_SIZE):
+        """Make *remote_file* match *local_file* by sending only the blocks that differ.
+
+        Both sides are hashed in blocks of *block_size*; the changed blocks are
+        pushed to a temporary file next to *remote_file*, and dd'd into place.
+        Falls back to a full sync_push if the device can't do that.
+        Returns the number of bytes sent."""
+        st = os.stat(local_file)
+        count = (st.st_size + block_size - 1) // block_size
+        r_mode, r_size, _ = self.sync_stat(sock, remote_file)
+        r_hashes = []
+        if r_mode != 0 and stat.S_ISREG(r_mode):
+            r_hashes = self.block_hashes(remote_file, block_size, count)
+        if not r_hashes:
+            self.sync_push(sock, local_file, remote_file)
+            return st.st_size
+
+        changed = []
+        with file(local_file, 'rb') as inf:
+            for i in xrange(count):
+                if hashlib.md5(inf.read(block_size)).hexdigest() != r_hashes[i]:
+                    changed.append(i)
+
+        # Changed blocks go out back to back; runs of them are copied into place
+        # with one dd each.  Commands are chained with && so one failure stops the rest.
+        tmp_file = remote_file + '.rsync-delta'
+        cmds, tmp_block = [], 0
+        for (start, n) in _runs(changed):
+            cmds.append('dd if=%s of=%s bs=%d skip=%d seek=%d count=%d conv=notrunc 2>/dev/null &&' % (
+                shell_quote(tmp_file), shell_quote(remote_file), block_size, tmp_block, start, n))
+            tmp_block += n
+        if r_size != _wire_size(sock, st.st_size):
+            # dd without notrunc cuts the file off where it starts writing
+            cmds.append('dd if=/dev/null of=%s bs=1 seek=%d 2>/dev/null &&' % (
+                shell_quote(remote_file), st.st_size))
+        # A failed touch is fine, but the OKAY after it must still wait on the dds
+        cmds.append('{ touch -c -m -d @%d %s 2>/dev/null; true; } &&' % (
+            st.st_mtime, shell_quote(remote_file)))
+
+        nsent = 0
+        if changed:
+            with file(local_file, 'rb') as inf:
+                blocks = _BlockReader(inf, changed, block_size)
+                _sync_send_stream(sock, tmp_file, 0644, blocks, st.st_mtime)
+                sync_recv_status(sock)
+                nsent = blocks.nread
+
+        suffix = ' echo OKAY'
+        ok = True
+        for chunk in _chunk_args(cmds, SHELL_CMD_MAX - len(suffix) - 1):
+            if 'OKAY' not in self.simple_shell(' '.join(chunk) + suffix):
+                ok = False
+                break
+        if changed:
+            self.simple_shell('rm -f %s' % shell_quote(tmp_file))
+        if ok and self.sync_stat(sock, remote_file)[1] == _wire_size(sock, st.st_size):
+            return nsent
+        # Half-patched, maybe; start over
+        self.sync_push(sock, local_file, remote_file)
+        return nsent + st.st_size
+
+    def sync_push_bundle(self, sock, items, remote_dir):
+        """Push lots of small files as one tar, and unpack it on the device.
 
+        *items* is a list of (local_file, remote_file, ...) tuples, as for
+        sync_push_many, and every remote_file must be under *remote_dir*.
+        mtimes are kept.  Returns False, having changed nothing, if the device
+        has no tar; the caller should push the files one by one instead."""
+        if getattr(self, '_no_tar', False):
+            return False
+        buf = StringIO()
+        tar = tarfile.open(fileobj=buf, mode='w', format=tarfile.GNU_FORMAT)
+        for item in items:
+            local_file, remote_file = item[0], item[1]
+            assert remote_file.startswith(remote_dir + '/'), (remote_file, remote_dir)
+            with file(local_file, 'rb') as inf:
+                st = os.fstat(inf.fileno())
+                info = tarfile.TarInfo(remote_file[len(remote_dir)+1:])
+                info.size, info.mtime, info.mode = st.st_size, int(st.st_mtime), 0644
+                tar.addfile(info, inf)
+        tar.close()
+        buf.seek(0)
+
+        tmp_file = '%s/.rsync-bundle-%s.tar' % (remote_dir, os.urandom(4).encode('hex'))
+        _sync_send_stream(sock, tmp_file, 0644, buf, 0, len(buf.getvalue()))
+        sync_recv_status(sock)
+        out = self.simple_shell('cd %s && tar xf %s && echo OKAY; rm -f %s' % (
+            shell_quote(remote_dir), shell_quote(tmp_file), shell_quote(tmp_file)))
+        if 'OKAY' in out:
+            return True
+        if 'not found' in out:
+            self._no_tar = True
+            return False
+        raise AdbError("Could not unpack files into %s: %s" % (remote_dir, out.strip()))
+
+    def sync_push_resumable(self, sock, local_file, remote_file, segment=RESUME_SEGMENT):
+        """sync_push for big files over connections that drop.
+
+        The file is pushed *segment* bytes at a time, each appended on the
+        device to a partial file next to *remote_file* (see resume_part_name).
+        If that's already there from an interrupted call, only the missing
+        tail is pushed, and the whole file's md5 is checked before it's moved
+        into place; if the device can't md5 it, the file is pushed again from
+        the start.  Every byte is written twice on the device, so a file that
+        fits in one segment is just pushed.  Returns the number of bytes sent."""
         st = os.stat(local_file)
-        if not stat.S_ISREG(st.st_mode):
-            raise AdbError("Cannot push %s: not S_ISREG" % local_file)
+        mode = self.sync_stat(sock, remote_file)[0]
+        if mode != 0 and stat.S_ISDIR(mode):
+            raise AdbError("Cannot push onto %s: is S_ISDIR" % remote_file)
+        part = resume_part_name(remote_file, st.st_size, st.st_mtime)
+        seg = part + '.seg'
+        done = self._full_size(sock, part, st.st_size) or 0
+        if done > st.st_size:
+            done = 0
+        if done == 0 and st.st_size <= segment:
+            self.sync_push(sock, local_file, remote_file)
+            return st.st_size
 
+        resumed = done
+        nsent = 0
         with file(local_file, 'rb') as inf:
-            augmented_remote_file = "%s,%d" % (remote_file, mode)
-            sync_send_req(sock, 'SEND', augmented_remote_file)
+            if done == 0:
+                # No partial file, or one we can't use: start a new one
+                self.simple_shell('rm -f %s' % shell_quote(part))
+            while done < st.st_size:
+                n = min(segment, st.st_size - done)
+                inf.seek(done)
+                _sync_send_stream(sock, seg, 0644, _LimitReader(inf, n), 0, n)
+                sync_recv_status(sock)
+                nsent += n
+                out = self.simple_shell('cat %s >> %s && rm -f %s && echo OKAY' % (
+                    shell_quote(seg), shell_quote(part), shell_quote(seg)))
+                if 'OKAY' not in out:
+                    raise AdbError("Could not append to %s: %s" % (part, out.strip()))
+                done += n
+
+        ok = self._full_size(sock, part, st.st_size) == st.st_size
+        if ok and resumed:
+            r_hash = self.file_hashes([part]).get(part)
+            ok = r_hash is not None and r_hash == _file_md5(local_file)
+        if not ok:
+            self.simple_shell('rm -f %s' % shell_quote(part))
+            if resumed:
+                # The part we picked up was bad, or couldn't be checked; push the whole thing
+                return nsent + self.sync_push_resumable(sock, local_file, remote_file, segment)
+            raise AdbError("Cannot push %s: came out the wrong size" % remote_file)
+
+        # Parts left over from older versions of the file go too, but only once
+        # the mv worked: an old remote_file says nothing about whether it did
+        out = self.simple_shell('mv -f %s %s && { touch -c -m -d @%d %s 2>/dev/null; '
+                                'rm -f %s*; echo OKAY; }' % (
+            shell_quote(part), shell_quote(remote_file), st.st_mtime, shell_quote(remote_file),
+            shell_quote(remote_file + RESUME_PART)))
+        if 'OKAY' not in out:
+            raise AdbError("Could not move %s into place: %s" % (part, out.strip()))
+        return nsent
+
+    def _full_size(self, sock, path, hint):
+        """Size of *path* on the device, or None if there's no such file.
+        v1 stats only have 32 bits, so if *hint* (the size we expect) says
+        that's not enough, ask the shell instead."""
+        mode, size, _ = self.sync_stat(sock, path)
+        if mode == 0:
+            return None
+        if 'stat_v2' in getattr(sock, 'features', ()) or hint <= 0xffffffff:
+            return size
+        out = self.simple_shell('stat -c %%s %s 2>/dev/null' % shell_quote(path)).strip()
+        if out.isdigit():
+            return int(out)
+        return None
+
+    def _pull_tail(self, remote_file, offset, outf):
+        """Write *remote_file* from byte *offset* on to *outf*.
+        Returns False if the device can't do that (no exec: service)."""
+        try:
+            sock = self.connect_and_send('exec:tail -c +%d %s 2>/dev/null' % (
+                offset + 1, shell_quote(remote_file)))
+        except AdbError:
+            return False
+        with closing(sock):
             while True:
-                data = inf.read(SYNC_DATA_MAX)
+                data = sock.recv(SYNC_DATA_MAX)
                 if data == '': break
-                sync_send_data_data(sock, data)
-            sync_send_data_done(sock, st.st_mtime)
-            sync_recv_status(sock)
+                outf.write(data)
+        return True
 
     def sync_pull(self, sock, remote_file, local_file):
         """Like adb pull.  Copies mtime but not permissions.
-        *local_file* may be a filename, or a file-like object."""
-        mode, _, mtime = self.sync_stat(sock, remote_file)
+        *local_file* may be a filename, or a file-like object.
+
+        The file is written to *local_file*.part first.  If a pull of at least
+        RESUME_MIN_SIZE bytes is interrupted, that's kept, and the next pull
+        of the same file fetches only the rest, then checks the whole file's md5."""
+        mode, size, mtime = self.sync_stat(sock, remote_file)
         if mode == 0:
             raise AdbError("Cannot pull %s: file does not exist" % remote_file)
         if not stat.S_ISREG(mode):
@@ -330,11 +1012,7 @@ df_test_mtime"""
 
         # Handle the case of a file-like object.
         if hasattr(local_file, 'write'):
-            sync_send_req(sock, 'RECV', remote_file)
-            while True:
-                id, data = sync_recv_data(sock)
-                if id == 'DONE': break
-                local_file.write(data)
+            _sync_recv_file(sock, remote_file, local_file)
             return
 
         # Check up-front for directories (because we're about to ignore any errors creating file)
@@ -343,27 +1021,54 @@ df_test_mtime"""
         except OSError:
             pass
         else:
-            if stat.S_ISDIR(st.mode):
+            if stat.S_ISDIR(st.st_mode):
                 raise AdbError("Cannot pull onto %s: is S_ISDIR" % local_file)
 
         try: os.makedirs(os.path.dirname(local_file))
         except OSError: pass
 
         tmp_file = local_file + '.part'
+        try: resumed = os.path.getsize(tmp_file)
+        except OSError: resumed = 0
+        if resumed:
+            full = self._full_size(sock, remote_file, 1 << 32)    # no idea how big; make sure
+            if full is None or resumed >= full:
+                resumed = 0
+            else:
+                size = full
+        keep = False
         try:
-            with file(tmp_file, 'wb') as outf:
-                sync_send_req(sock, 'RECV', remote_file)
-                while True:
-                    id, data = sync_recv_data(sock)
-                    if id == 'DONE': break
-                    outf.write(data)
+            if resumed:
+                with file(tmp_file, 'ab') as outf:
+                    if not self._pull_tail(remote_file, resumed, outf):
+                        resumed = 0
+            if not resumed:
+                with file(tmp_file, 'wb') as outf:
+                    _sync_recv_file(sock, remote_file, outf)
+            if resumed: ok = os.path.getsize(tmp_file) == size
+            else:       ok = _wire_size(sock, os.path.getsize(tmp_file)) == size
+            if ok and resumed:
+                r_hash = self.file_hashes([remote_file]).get(remote_file)
+                ok = r_hash is None or r_hash == _file_md5(tmp_file)
+            if not ok:
+                if resumed:
+                    # The part we picked up was bad; pull the whole thing
+                    os.unlink(tmp_file)
+                    return self.sync_pull(sock, remote_file, local_file)
+                raise AdbError("Cannot pull %s: came out the wrong size" % remote_file)
             try: os.unlink(local_file)
             except OSError: pass
             os.rename(tmp_file, local_file)
             os.utime(local_file, (mtime, mtime))
-        finally:
-            try: os.unlink(tmp_file)
+        except:
+            # Keep a big enough partial file for next time
+            try: keep = os.path.getsize(tmp_file) >= RESUME_MIN_SIZE
             except OSError: pass
+            raise
+        finally:
+            if not keep:
+                try: os.unlink(tmp_file)
+                except OSError: pass
 
 # ----------------------------------------------------------------------
 # The 'sync:' protocol
@@ -371,55 +1076,383 @@ df_test_mtime"""
 
 # See system/core/adb/file_sync_service.h, union syncmsg
 # The union contains 5 message types: req, stat, dent (dirent), data, status.
+#
+# Newer adbd (see file_sync_protocol.h) also speaks v2 versions of some of
+# them, each behind a feature from host:features:
+#
+#   stat_v2        LST2 (and STA2): 64-bit sizes and times, and an errno
+#   ls_v2          LIS2, answered with DNT2s: likewise, for each entry
+#   sendrecv_v2    SND2 and RCV2: mode and flags go in a setup message after
+#                  the path, rather than in it; flags can ask for the DATA to
+#                  be compressed (sendrecv_v2_brotli, _lz4, _zstd)
+#
+# The sync_* functions use whichever the connection's features allow (see
+# _ConnectionPool._ready), and the v1 messages otherwise.
+
+_SYNC_HDR = struct.Struct('<4sI')   # id + length, shared by req, data and status messages
+_SYNC_STAT = struct.Struct('<4s3I') # id, mode, size, time
+_SYNC_DENT = struct.Struct('<4s4I') # id, mode, size, time, namelen
+# id, error, dev, ino, mode, nlink, uid, gid, size, atime, mtime, ctime (+ namelen for DNT2)
+_SYNC_STAT2 = struct.Struct('<4sIQQIIIIQqqq')
+_SYNC_DENT2 = struct.Struct('<4sIQQIIIIQqqqI')
+_SYNC_SEND2 = struct.Struct('<4sII')    # SND2 setup: id, mode, flags
+
+# ----------------------------------------------------------------------
+# Compression, for SND2 and RCV2
+
+class SyncCodec(object):
+    """A compression scheme adbd understands.  *compressor()* returns an object
+    with compress(data) and flush(); *decompressor()* one with decompress(data)."""
+    def __init__(self, name, flag, compressor, decompressor):
+        self.name = name
+        self.flag = flag                # for the SND2/RCV2 setup message
+        self.feature = 'sendrecv_v2_' + name
+        self.compressor = compressor
+        self.decompressor = decompressor
+
+    def __repr__(self):
+        return '<SyncCodec %s>' % self.name
+
+class _Lz4Compressor(object):
+    def __init__(self):
+        self.c = lz4_frame.LZ4FrameCompressor()
+        self.head = self.c.begin()
+    def compress(self, data):
+        head, self.head = self.head, ''
+        return head + self.c.compress(data)
+    def flush(self):
+        head, self.head = self.head, ''
+        return head + self.c.flush()
+
+class _BrotliCompressor(object):
+    def __init__(self):
+        self.c = brotli.Compressor(quality=1)
+    def compress(self, data):
+        return self.c.process(data)
+    def flush(self):
+        return self.c.finish()
+
+class _BrotliDecompressor(object):
+    def __init__(self):
+        self.d = brotli.Decompressor()
+    def decompress(self, data):
+        return self.d.process(data)
+
+# Best first.  Only the ones whose module is installed.
+SYNC_CODECS = []
+if zstandard is not None:
+    SYNC_CODECS.append(SyncCodec('zstd', 4,
+                                 lambda: zstandard.ZstdCompressor(level=1).compressobj(),
+                                 lambda: zstandard.ZstdDecompressor().decompressobj()))
+if lz4_frame is not None:
+    SYNC_CODECS.append(SyncCodec('lz4', 2, _Lz4Compressor, lz4_frame.LZ4FrameDecompressor))
+if brotli is not None:
+    SYNC_CODECS.append(SyncCodec('brotli', 1, _BrotliCompressor, _BrotliDecompressor))
+
+class _DecompressingWriter(object):
+    """Writes to *outf* whatever *decompressor* makes of the data written to it."""
+    def __init__(self, outf, decompressor):
+        self.outf = outf
+        self.decompressor = decompressor
+    def write(self, data):
+        data = self.decompressor.decompress(data)
+        if data:
+            self.outf.write(data)
+
+# ----------------------------------------------------------------------
 
 def sync_send_req(sock, id, data):
     """Send a syncmsg::req message"""
     # id may be 'list', ...?
-    sock.send(struct.pack('<4sI', id, len(data)))
-    if len(data):
-        sock.send(data)
+    trace.count('frames_sent')
+    sock.sendall(_SYNC_HDR.pack(id, len(data)) + data)
+
+def _wire_size(sock, size):
+    """*size* as the device will report it over *sock*: v1 stats only have 32 bits."""
+    if 'stat_v2' in getattr(sock, 'features', ()):
+        return size
+    return size & 0xffffffff
+
+def _sync_iterlist(sock, path):
+    """Send LIST (or LIS2), and yield (mode, size, mtime, name) for each entry."""
+    if 'ls_v2' in getattr(sock, 'features', ()):
+        sync_send_req(sock, 'LIS2', path)
+        recv = sync_recv_dirent2
+    else:
+        sync_send_req(sock, 'LIST', path)
+        recv = sync_recv_dirent
+    while True:
+        (id,mode,size,mtime,name) = recv(sock)
+        if id == 'DONE': break
+        yield (mode, size, mtime, name)
+
+def _sync_recv_file(sock, remote_file, outf):
+    """Send RECV (or RCV2), and write the file's contents to *outf*."""
+    if 'sendrecv_v2' in getattr(sock, 'features', ()):
+        codec = getattr(sock, 'codec', None)
+        trace.count('frames_sent', 2)
+        sock.sendall(_SYNC_HDR.pack('RCV2', len(remote_file)) + remote_file +
+                     _SYNC_HDR.pack('RCV2', codec.flag if codec else 0))
+        if codec is not None:
+            outf = _DecompressingWriter(outf, codec.decompressor())
+    else:
+        sync_send_req(sock, 'RECV', remote_file)
+    while sync_recv_data_to(sock, outf) != 'DONE':
+        pass
+
+def _sync_send_file(sock, local_file, remote_file, mode):
+    """Send the SEND/DATA/DONE sequence for one file, without waiting for the status.
+    *local_file* may be a filename, or a file-like object.
+    *mode* is the st_mode of the existing remote file (0 if none)."""
+    # Handle case of file-like object.
+    if hasattr(local_file, 'read'):
+        mode, mtime = 0644, 0
+        _sync_send_stream(sock, remote_file, mode, local_file, mtime)
+        return
+
+    st = os.stat(local_file)
+    if not stat.S_ISREG(st.st_mode):
+        raise AdbError("Cannot push %s: not S_ISREG" % local_file)
+
+    with file(local_file, 'rb') as inf:
+        _sync_send_stream(sock, remote_file, mode, inf, st.st_mtime, st.st_size)
+
+def _runs(indices):
+    """Yield (start, length) for each run of consecutive numbers in sorted *indices*."""
+    start = prev = None
+    for i in indices:
+        if prev is not None and i == prev + 1:
+            prev = i
+            continue
+        if start is not None:
+            yield (start, prev - start + 1)
+        start = prev = i
+    if start is not None:
+        yield (start, prev - start + 1)
+
+class _BlockReader(object):
+    """File-like object that reads just the given blocks of *inf*, back to back."""
+    def __init__(self, inf, blocks, block_size):
+        self.inf = inf
+        self.blocks = iter(blocks)
+        self.block_size = block_size
+        self.left = 0           # unread bytes of the current block
+        self.nread = 0
+
+    def read(self, n):
+        while self.left == 0:
+            try: block = self.blocks.next()
+            except StopIteration: return ''
+            self.inf.seek(block * self.block_size)
+            self.left = self.block_size
+        data = self.inf.read(min(n, self.left))
+        self.left = 0 if len(data) < min(n, self.left) else self.left - len(data)
+        self.nread += len(data)
+        return data
+
+class _LimitReader(object):
+    """File-like object that reads no more than *n* bytes of *inf*."""
+    def __init__(self, inf, n):
+        self.inf = inf
+        self.left = n
+
+    def read(self, n):
+        data = self.inf.read(min(n, self.left))
+        self.left -= len(data)
+        return data
+
+def _file_md5(path):
+    """Hex md5 of local file *path*."""
+    h = hashlib.md5()
+    with file(path, 'rb') as inf:
+        while True:
+            data = inf.read(1024*1024)
+            if not data: break
+            h.update(data)
+    return h.hexdigest()
+
+def resume_part_name(remote_file, size, mtime):
+    """Where sync_push_resumable keeps a partial *remote_file* of the given
+    local size and mtime.  A changed local file gets a fresh one."""
+    return '%s%s%x-%x' % (remote_file, RESUME_PART, size, int(mtime))
+
+def resume_part_owner(name):
+    """If *name* is one of sync_push_resumable's partial files (or the segment
+    next to one), return the name of the file it's for; otherwise None."""
+    i = name.rfind(RESUME_PART)
+    if i <= 0:
+        return None
+    return name[:i]
+
+def _readinto(inf, view):
+    """inf.readinto(view), for file-like objects that may only have read()"""
+    readinto = getattr(inf, 'readinto', None)
+    if readinto is not None:
+        return readinto(view)
+    data = inf.read(len(view))
+    view[:len(data)] = data
+    return len(data)
+
+def _sync_send_stream(sock, remote_file, mode, inf, mtime, size=None):
+    """Send SEND (or SND2) for *remote_file*, then the contents of *inf* as
+    DATA messages, then DONE.
+
+    Messages are packed back to back into one buffer, which is reused for every
+    chunk, and written with sendall.  The SEND rides along with the first DATA.
+    If *size* says we've reached the end of the file, we check for EOF while
+    there's still room, so the DONE rides along with the last DATA.  A file
+    that fits in one chunk goes out in a single write."""
+    if 'sendrecv_v2' in getattr(sock, 'features', ()):
+        codec = getattr(sock, 'codec', None)
+        head = (_SYNC_HDR.pack('SND2', len(remote_file)) + remote_file +
+                _SYNC_SEND2.pack('SND2', mode, codec.flag if codec else 0))
+        if codec is not None:
+            return _sync_send_compressed(sock, head, inf, mtime, codec)
+    else:
+        target = "%s,%d" % (remote_file, mode)
+        head = _SYNC_HDR.pack('SEND', len(target)) + target
+    chunk = SYNC_DATA_MAX if size is None else max(1, min(size, SYNC_DATA_MAX))
+    # Room for the SEND, one chunk, a 1-byte EOF probe and the DONE
+    buf = bytearray(len(head) + 8 + chunk + 8 + 1 + 8)
+    view = memoryview(buf)
+    buf[:len(head)] = head
+    pos = len(head)     # buf[:pos] is packed and waiting to be sent
+    total = frames = 0
+    while True:
+        room = len(buf) - pos - 16      # data space, leaving room for this DATA and a DONE header
+        if size is not None and total >= size and room >= 1:
+            want = min(room, SYNC_DATA_MAX)     # expecting EOF, but the file may have grown
+        elif room >= chunk:
+            want = min(room, SYNC_DATA_MAX)
+        else:
+            sock.sendall(view[:pos])
+            pos = 0
+            continue
+        n = _readinto(inf, view[pos+8:pos+8+want])
+        if n == 0:
+            _SYNC_HDR.pack_into(buf, pos, 'DONE', int(mtime))
+            sock.sendall(view[:pos+8])
+            trace.count('frames_sent', frames + 2)
+            return
+        _SYNC_HDR.pack_into(buf, pos, 'DATA', n)
+        pos += 8 + n
+        total += n
+        frames += 1
+
+def _sync_send_compressed(sock, head, inf, mtime, codec):
+    """Like _sync_send_stream, after *head*, but the DATA is compressed with *codec*."""
+    compressor = codec.compressor()
+    out = [head]
+    frames = 0
+    while True:
+        data = inf.read(SYNC_DATA_MAX)
+        z = compressor.compress(data) if data else compressor.flush()
+        for i in xrange(0, len(z), SYNC_DATA_MAX):
+            piece = z[i:i+SYNC_DATA_MAX]
+            out.append(_SYNC_HDR.pack('DATA', len(piece)))
+            out.append(piece)
+            frames += 1
+        if not data:
+            break
+        if len(out) > 1:
+            sock.sendall(''.join(out))
+            out = []
+    out.append(_SYNC_HDR.pack('DONE', int(mtime)))
+    sock.sendall(''.join(out))
+    trace.count('frames_sent', frames + 2)
+
+def _sync_recv_push_status(sock, remote_file):
+    """sync_recv_status, but the error names *remote_file*."""
+    try:
+        sync_recv_status(sock)
+    except AdbError as e:
+        raise AdbError("Cannot push %s: %s" % (remote_file, e))
 
 def sync_recv_stat(sock):
     """Receive a syncmsg::stat message.
     Return (id, mode, size, time).
     id is always 'STAT'."""
     # "stat": ("IIII", struct.calcsize("IIII")),   # id, mode, size, time
-    id, mode, size, time = struct.unpack('<4s3I', _recvall(sock,4*4))
+    trace.count('frames_recv')
+    id, mode, size, time = _recv_struct(sock, _SYNC_STAT)
     if id != 'STAT':
         raise ProtocolError("msg.stat contained weird id %s" % (id,))
     return (id,mode,size,time)
 
+def sync_recv_stat2(sock):
+    """Receive the reply to a STA2 or LST2.
+    Return (id, mode, size, time), with mode 0 if the stat failed, as for v1."""
+    trace.count('frames_recv')
+    (id, error, dev, ino, mode, nlink, uid, gid, size, atime, mtime, ctime
+     ) = _recv_struct(sock, _SYNC_STAT2)
+    if id not in ('STA2', 'LST2'):
+        raise ProtocolError("msg.stat_v2 contained weird id %s" % (id,))
+    if error:
+        return (id, 0, 0, 0)
+    return (id, mode, size, mtime)
+
 def sync_recv_dirent(sock):
     """Receive a syncmsg::dirent message.
     Return (id, mode, size, time, name).
     id is one of 'DONE' (in which case message is all zeroes), 'DENT'."""
-    id, mode, size, time, namelen = struct.unpack('<4s4I', _recvall(sock, 5*4))
+    trace.count('frames_recv')
+    id, mode, size, time, namelen = _recv_struct(sock, _SYNC_DENT)
     name = '' if namelen == 0 else _recvall(sock,namelen)
     if id not in ('DONE', 'DENT'):
         raise ProtocolError("msg.dent contained weird id %s" % (id,))
     return (id,mode,size,time,name)
 
+def sync_recv_dirent2(sock):
+    """Receive a DNT2 message, the reply to LIS2.
+    Return (id, mode, size, time, name).
+    id is one of 'DONE' (in which case message is all zeroes), 'DNT2'."""
+    trace.count('frames_recv')
+    (id, error, dev, ino, mode, nlink, uid, gid, size, atime, mtime, ctime, namelen
+     ) = _recv_struct(sock, _SYNC_DENT2)
+    name = '' if namelen == 0 else _recvall(sock,namelen)
+    if id not in ('DONE', 'DNT2'):
+        raise ProtocolError("msg.dent_v2 contained weird id %s" % (id,))
+    if error:
+        mode = 0        # couldn't lstat it; neither a file nor a dir, then
+    return (id,mode,size,mtime,name)
+
 def sync_send_data_data(sock, data):
     """Send a syncmsg::data message containing data."""
-    sock.send(struct.pack('<4sI', 'DATA', len(data)))
-    sock.send(data)
+    trace.count('frames_sent')
+    sock.sendall(_SYNC_HDR.pack('DATA', len(data)) + data)
 def sync_send_data_done(sock, mtime):
     """Send a syncmsg::data message containing "end of file" data (which includes a timestamp)"""
-    sock.send(struct.pack('<4sI', 'DONE', mtime))
+    trace.count('frames_sent')
+    sock.sendall(_SYNC_HDR.pack('DONE', int(mtime)))
 
 def sync_recv_data(sock):
     """Receive a syncmsg::data message.
     id is one of 'DONE' (in which case data is empty), 'DATA'."""
-    id, datalen = struct.unpack('<4sI', _recvall(sock,2*4))
+    trace.count('frames_recv')
+    id, datalen = _recv_struct(sock, _SYNC_HDR)
     data = '' if datalen == 0 else _recvall(sock, datalen)
     if id not in ('DATA', 'DONE'):
         raise ProtocolError("msg.data contained weird id %s" % (id,))
     return (id, data)
 
+def sync_recv_data_to(sock, outf):
+    """Receive a syncmsg::data message, writing its data to *outf*.
+    Returns the id, which is one of 'DONE' (no data), 'DATA'."""
+    trace.count('frames_recv')
+    id, datalen = _recv_struct(sock, _SYNC_HDR)
+    if id not in ('DATA', 'DONE'):
+        raise ProtocolError("msg.data contained weird id %s" % (id,))
+    if id == 'DATA':
+        recv_to = getattr(sock, 'recv_to', None)
+        if recv_to is not None: recv_to(outf, datalen)
+        else: outf.write(_recvall(sock, datalen))
+    return id
+
 def sync_recv_status(sock):
     """Receive a syncmsg::status msg.
     On error, raise AdbError; otherwise return nothing."""
-    id, msglen = struct.unpack('<4sI', _recvall(sock,2*4))
+    trace.count('frames_recv')
+    id, msglen = _recv_struct(sock, _SYNC_HDR)
     message = '' if msglen == 0 else _recvall(sock, msglen)
     if id == 'OKAY':
         if message:
@@ -428,6 +1461,39 @@ def sync_recv_status(sock):
         raise AdbError("Received FAIL: %s" % message)
 
 dirent = namedtuple('dirent', 'mode size mtime name')
+
+class DirentList(object):
+    """A list of dirents that's kept a column at a time: the names in a list,
+    and the numbers in arrays.  For holding a whole tree's worth of files
+    without a tuple, long and float for each; a dirent is made as each item
+    is read."""
+    __slots__ = ('modes', 'sizes', 'mtimes', 'names')
+
+    def __init__(self, items=()):
+        self.modes = array('l')
+        self.sizes = array('d')     # exact up to 2**53; Python 2's array has no 'q'
+        self.mtimes = array('d')
+        self.names = []
+        for de in items:
+            self.append(de)
+
+    def append(self, de):
+        (mode, size, mtime, name) = de
+        self.modes.append(mode)
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+        self.names.append(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        return dirent(self.modes[i], int(self.sizes[i]), self.mtimes[i], self.names[i])
+
+    def __iter__(self):
+        for (mode, size, mtime, name) in izip(self.modes, self.sizes, self.mtimes, self.names):
+            yield dirent(mode, int(size), mtime, name)
+
 def sync_walk(sock, root):
     """Not really part of the sync: suite of commands, but a useful
     high-level function patterned after os.walk.
@@ -435,10 +1501,7 @@ def sync_walk(sock, root):
     *dirs* and *files* are lists of *dirent* instances."""
     dirs, files = [], []
 
-    sync_send_req(sock, 'LIST', root)
-    while True:
-        (id,mode,size,mtime,name) = sync_recv_dirent(sock)
-        if id == 'DONE': break;
+    for (mode,size,mtime,name) in _sync_iterlist(sock, root):
         if stat.S_ISDIR(mode):
             if name != '.' and name != '..':
                 dirs.append( dirent(mode, size, mtime, name) )
@@ -451,6 +1514,52 @@ def sync_walk(sock, root):
         for tup in sync_walk(sock, root+'/'+subdir.name):
             yield tup
 
+def tree_walk(root, tree, consume=False):
+    """Like sync_walk, but replays *tree*, a dict mapping each directory to
+    its (dirs, files), instead of asking the device.  Directories missing
+    from *tree* are empty, as they are for LIST.
+    If *consume*, each directory is removed from *tree* as it's walked."""
+    if consume: (dirs, files) = tree.pop(root, ((), ()))
+    else:       (dirs, files) = tree.get(root, ((), ()))
+    dirs, files = list(dirs), list(files)
+    yield (root, dirs, files)
+
+    for subdir in dirs:
+        for tup in tree_walk(root+'/'+subdir.name, tree, consume):
+            yield tup
+
+def _stat_entries(out):
+    """Yield (hex mode, size, mtime, path) for each entry in list_tree()'s find
+    output, with path None for the root.  A line that doesn't start a new entry
+    is the rest of the last one's name, which had a newline in it.  Raise
+    ValueError at anything else."""
+    entry = None
+    for line in _iterlines(out):
+        line = line.rstrip('\r')
+        m = _stat_line_re.match(line)
+        if m is not None:
+            if entry is not None:
+                yield entry
+            entry = m.groups()
+        elif entry is not None and entry[3] is not None:
+            entry = entry[:3] + (entry[3] + '\n' + line,)
+        elif line or entry is not None:
+            if entry is not None:
+                yield entry     # the root, which is complete
+            raise ValueError("Not find and stat output: %r" % line)
+    if entry is not None:
+        yield entry
+
+def _iterlines(text):
+    """Yield the lines of *text*, without building a list of them all."""
+    pos = 0
+    while pos < len(text):
+        end = text.find('\n', pos)
+        if end < 0:
+            end = len(text)
+        yield text[pos:end]
+        pos = end + 1
+
 
 # ----------------------------------------------------------------------
 # Testing
@@ -477,8 +1586,7 @@ def test():
     def print_stat(tup):
         (flags, size, t) = tup
         print "%06o  %05x  %s" % (flags, size, _fmt_unixtime(t))
-    c = AdbClient()
-    device = c.devices()[0]
+    device = adb_get_devices()[0]
     print repr(device.does_mtime_work())
     for k,v in sorted(device.get_build_props().items()):
         print k,v
@@ -0,0 +1,558 @@
+# -*- python -*-
+#
+# Copyright 2008 - 2015 Double Fine Productions
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#
+# Non-blocking version of android.adb, for driving lots of devices and
+# transfers from one thread.
+#
+# There's no asyncio in python 2, so this comes with a little event loop of
+# its own.  Coroutines are generators, in the style of trollius and tornado:
+#
+#   def push_all(device, files):
+#       sock = yield device.open_sync()
+#       for (local, remote) in files:
+#           yield device.sync_push(sock, local, remote)
+#       yield device.close_sync(sock)
+#
+#   aio.run(aio.gather(*[push_all(AsyncAdbDevice(d), files) for d in devices]))
+#
+# Yielding a generator runs it to completion and evaluates to its result,
+# which it gives with "raise Return(value)".  Yielding a Task waits for it.
+# Local file I/O is still blocking; only the sockets are multiplexed.
+#
+
+import os
+import sys
+import stat
+import time
+import heapq
+import errno
+import types
+import select
+import socket
+from collections import deque
+
+import android.adb as adb
+from android.utils import AdbError, ProtocolError
+
+__all__ = ('Return', 'EventLoop', 'Task', 'Semaphore', 'run', 'spawn', 'gather', 'sleep',
+           'AsyncSocket', 'AsyncAdbDevice')
+
+# ----------------------------------------------------------------------
+# Event loop
+# ----------------------------------------------------------------------
+
+class Return(StopIteration):
+    """raise Return(value) to give a coroutine's result."""
+    def __init__(self, value=None):
+        StopIteration.__init__(self, value)
+        self.value = value
+
+
+class _Wait(object):
+    """Base for the things a coroutine can yield to be suspended."""
+    def arm(self, loop, task):
+        raise NotImplementedError
+
+class _Readable(_Wait):
+    def __init__(self, fileno): self.fileno = fileno
+    def arm(self, loop, task): loop._readers[self.fileno] = task
+
+class _Writable(_Wait):
+    def __init__(self, fileno): self.fileno = fileno
+    def arm(self, loop, task): loop._writers[self.fileno] = task
+
+class _Sleep(_Wait):
+    def __init__(self, delay): self.delay = delay
+    def arm(self, loop, task): loop._call_at(time.time() + self.delay, task)
+
+class _Spawn(_Wait):
+    def __init__(self, coro): self.coro = coro
+    def arm(self, loop, task): loop._ready.append((task, loop.spawn(self.coro), None))
+
+
+def sleep(delay):
+    """yield sleep(delay) to suspend for *delay* seconds."""
+    return _Sleep(delay)
+
+def spawn(coro):
+    """yield spawn(coro) to start *coro* as a separate Task, which is returned."""
+    return _Spawn(coro)
+
+def gather(*coros):
+    """Coroutine: run all of *coros* concurrently, and return a list of their results.
+    Raises the first exception, after the coroutine that raised it has finished."""
+    tasks = []
+    for coro in coros:
+        tasks.append((yield spawn(coro)))
+    results = []
+    for task in tasks:
+        results.append((yield task))
+    raise Return(results)
+
+
+class Task(object):
+    """A coroutine being run by an EventLoop.  Yield one to wait for its result."""
+    def __init__(self, coro):
+        self._stack = [coro]    # generators calling generators
+        self._waiters = []
+        self.done = False
+        self.result = None
+        self.exc_info = None
+
+    def _finish(self, loop, result, exc_info):
+        self.done = True
+        self.result, self.exc_info = result, exc_info
+        for task in self._waiters:
+            loop._ready.append((task, result, exc_info))
+        del self._waiters[:]
+
+
+class EventLoop(object):
+    """Runs Tasks, switching between them whenever one has to wait on a socket."""
+    def __init__(self):
+        self._ready = deque()   # (task, value to send, exc_info to throw)
+        self._readers = {}      # fileno -> task
+        self._writers = {}
+        self._timers = []       # heap of (time, seq, task)
+        self._seq = 0
+
+    def spawn(self, coro):
+        """Start running *coro*; returns its Task."""
+        task = Task(coro)
+        self._ready.append((task, None, None))
+        return task
+
+    def run_until_complete(self, coro):
+        """Run *coro* (and everything else) until it finishes, and return its result."""
+        task = coro if isinstance(coro, Task) else self.spawn(coro)
+        while not task.done:
+            self._run_once()
+        if task.exc_info is not None:
+            raise task.exc_info[0], task.exc_info[1], task.exc_info[2]
+        return task.result
+
+    def _call_at(self, t, task):
+        self._seq += 1
+        heapq.heappush(self._timers, (t, self._seq, task))
+
+    def _run_once(self):
+        if not self._ready:
+            self._poll()
+        for i in xrange(len(self._ready)):
+            task, value, exc_info = self._ready.popleft()
+            self._step(task, value, exc_info)
+
+    def _poll(self):
+        if not (self._readers or self._writers or self._timers):
+            raise RuntimeError("Nothing left to run, but the task isn't finished")
+        timeout = None
+        if self._timers:
+            timeout = max(0, self._timers[0][0] - time.time())
+        if self._readers or self._writers:
+            r, w, _ = select.select(self._readers.keys(), self._writers.keys(), [], timeout)
+        else:
+            time.sleep(timeout)
+            r, w = [], []
+        for fileno in r:
+            self._ready.append((self._readers.pop(fileno), None, None))
+        for fileno in w:
+            self._ready.append((self._writers.pop(fileno), None, None))
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            self._ready.append((heapq.heappop(self._timers)[2], None, None))
+
+    def _step(self, task, value, exc_info):
+        """Run *task* until it has to wait for something."""
+        stack = task._stack
+        while True:
+            gen = stack[-1]
+            try:
+                if exc_info is not None:
+                    yielded = gen.throw(exc_info[0], exc_info[1], exc_info[2])
+                else:
+                    yielded = gen.send(value)
+            except StopIteration as e:
+                stack.pop()
+                value, exc_info = getattr(e, 'value', None), None
+                if not stack:
+                    task._finish(self, value, None)
+                    return
+                continue
+            except Exception:
+                stack.pop()
+                value, exc_info = None, sys.exc_info()
+                if not stack:
+                    task._finish(self, None, exc_info)
+                    return
+                continue
+
+            value, exc_info = None, None
+            if isinstance(yielded, types.GeneratorType):
+                stack.append(yielded)
+            elif isinstance(yielded, _Wait):
+                yielded.arm(self, task)
+                return
+            elif isinstance(yielded, Task):
+                if not yielded.done:
+                    yielded._waiters.append(task)
+                    return
+                value, exc_info = yielded.result, yielded.exc_info
+            else:
+                exc_info = (TypeError, TypeError("Coroutine yielded %r" % (yielded,)), None)
+
+
+def run(coro):
+    """Run *coro* on a new EventLoop, and return its result."""
+    return EventLoop().run_until_complete(coro)
+
+
+class Semaphore(object):
+    """Caps how many coroutines can be in some section at once.
+
+        yield sem.acquire()
+        try: ...
+        finally: sem.release()
+    """
+    def __init__(self, value):
+        self.value = value
+        self._waiters = deque()     # (loop, task)
+
+    def acquire(self):
+        if self.value > 0:
+            self.value -= 1
+            return
+        yield _SemaphoreWait(self)
+
+    def release(self):
+        if self._waiters:
+            loop, task = self._waiters.popleft()
+            loop._ready.append((task, None, None))
+        else:
+            self.value += 1
+
+class _SemaphoreWait(_Wait):
+    def __init__(self, sem): self.sem = sem
+    def arm(self, loop, task): self.sem._waiters.append((loop, task))
+
+# ----------------------------------------------------------------------
+# Sockets
+# ----------------------------------------------------------------------
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS)
+
+class AsyncSocket(object):
+    """Non-blocking socket with a receive buffer.  The send and recv methods
+    are coroutines.
+
+    sendall() doesn't finish until the kernel has taken all of the data, so a
+    sender that waits on it before producing more can't run ahead of the device."""
+    RECV_SIZE = 256*1024
+
+    def __init__(self, sock=None):
+        if sock is None:
+            sock = socket.socket()
+        sock.setblocking(False)
+        self.sock = sock
+        self._buf = bytearray()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+    def connect(self, address):
+        err = self.sock.connect_ex(address)
+        if err in _WOULD_BLOCK:
+            yield _Writable(self.fileno())
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err not in (0, errno.EISCONN):
+            raise socket.error(err, os.strerror(err))
+
+    def sendall(self, data):
+        view = memoryview(data)
+        while len(view):
+            try:
+                n = self.sock.send(view)
+            except socket.error as e:
+                if e.args[0] not in _WOULD_BLOCK:
+                    raise
+                yield _Writable(self.fileno())
+                continue
+            view = view[n:]
+
+    def _recv_more(self):
+        """Add whatever's available (waiting if nothing is) to the buffer.
+        Returns False on EOF."""
+        while True:
+            try:
+                data = self.sock.recv(self.RECV_SIZE)
+            except socket.error as e:
+                if e.args[0] not in _WOULD_BLOCK:
+                    raise
+                yield _Readable(self.fileno())
+                continue
+            self._buf += data
+            raise Return(data != '')
+
+    def recv(self, size):
+        """Receive up to *size* bytes; '' at EOF."""
+        if not self._buf:
+            yield self._recv_more()
+        data = str(self._buf[:size])
+        del self._buf[:size]
+        raise Return(data)
+
+    def recvall(self, size):
+        """Receive exactly *size* bytes."""
+        while len(self._buf) < size:
+            if not (yield self._recv_more()):
+                raise AdbError("Connection closed unexpectedly")
+        data = str(self._buf[:size])
+        del self._buf[:size]
+        raise Return(data)
+
+    def recv_struct(self, st):
+        """Receive and unpack a struct.Struct."""
+        while len(self._buf) < st.size:
+            if not (yield self._recv_more()):
+                raise AdbError("Connection closed unexpectedly")
+        tup = st.unpack_from(self._buf)
+        del self._buf[:st.size]
+        raise Return(tup)
+
+# ----------------------------------------------------------------------
+# Host protocol
+# ----------------------------------------------------------------------
+
+def adb_connect():
+    """Coroutine: return an AsyncSocket connected to the adb server."""
+    sock = AsyncSocket()
+    try:
+        yield sock.connect((adb.ADB_HOST, adb.ADB_PORT))
+    except socket.error:
+        sock.close()
+        raise AdbError("Cannot contact server; try 'adb start-server'")
+    raise Return(sock)
+
+def adb_recv_stat(sock):
+    """Receive 'OKAY' or 'FAIL', and raise AdbError on failure."""
+    stat = yield sock.recvall(4)
+    if stat == "OKAY":
+        return
+    elif stat == "FAIL":
+        size = int((yield sock.recvall(4)), 16)
+        raise AdbError((yield sock.recvall(size)))
+    else:
+        raise AdbError("Bad response: %r" % (stat,))
+
+def adb_send_command(sock, cmd):
+    """Wrap envelope around *cmd*, send, receive ack."""
+    yield sock.sendall("%04x%s" % (len(cmd), cmd))
+    try:
+        yield adb_recv_stat(sock)
+    except AdbError:
+        sock.close()
+        raise
+
+def adb_connect_and_send(cmd):
+    """Coroutine: adb_connect() and adb_send_command().  Returns sock."""
+    sock = yield adb_connect()
+    yield adb_send_command(sock, cmd)
+    raise Return(sock)
+
+# ----------------------------------------------------------------------
+# The 'sync:' protocol
+# ----------------------------------------------------------------------
+
+def sync_send_req(sock, id, data):
+    """Send a syncmsg::req message"""
+    yield sock.sendall(adb._SYNC_HDR.pack(id, len(data)) + data)
+
+def sync_recv_stat(sock):
+    """Receive a syncmsg::stat message.  Return (id, mode, size, time)."""
+    id, mode, size, time = yield sock.recv_struct(adb._SYNC_STAT)
+    if id != 'STAT':
+        raise ProtocolError("msg.stat contained weird id %s" % (id,))
+    raise Return((id, mode, size, time))
+
+def sync_recv_dirent(sock):
+    """Receive a syncmsg::dirent message.  Return (id, mode, size, time, name)."""
+    id, mode, size, time, namelen = yield sock.recv_struct(adb._SYNC_DENT)
+    name = '' if namelen == 0 else (yield sock.recvall(namelen))
+    if id not in ('DONE', 'DENT'):
+        raise ProtocolError("msg.dent contained weird id %s" % (id,))
+    raise Return((id, mode, size, time, name))
+
+def sync_recv_data(sock):
+    """Receive a syncmsg::data message.  Return (id, data)."""
+    id, datalen = yield sock.recv_struct(adb._SYNC_HDR)
+    if id not in ('DATA', 'DONE'):
+        raise ProtocolError("msg.data contained weird id %s" % (id,))
+    data = '' if (datalen == 0 or id == 'DONE') else (yield sock.recvall(datalen))
+    raise Return((id, data))
+
+def sync_recv_status(sock):
+    """Receive a syncmsg::status msg.  On error, raise AdbError."""
+    id, msglen = yield sock.recv_struct(adb._SYNC_HDR)
+    message = '' if msglen == 0 else (yield sock.recvall(msglen))
+    if id != 'OKAY':
+        raise AdbError("Received FAIL: %s" % message)
+
+def sync_walk(sock, root):
+    """Coroutine: return the whole tree under *root*, as a list of the
+    (root, dirs, files) tuples adb.sync_walk would yield."""
+    out = []
+    todo = [root]
+    while todo:
+        path = todo.pop()
+        dirs, files = [], []
+        yield sync_send_req(sock, 'LIST', path)
+        while True:
+            (id, mode, size, mtime, name) = yield sync_recv_dirent(sock)
+            if id == 'DONE': break
+            if stat.S_ISDIR(mode):
+                if name != '.' and name != '..':
+                    dirs.append(adb.dirent(mode, size, mtime, name))
+            elif stat.S_ISREG(mode):
+                files.append(adb.dirent(mode, size, mtime, name))
+        out.append((path, dirs, files))
+        todo.extend(path + '/' + d.name for d in reversed(dirs))
+    raise Return(out)
+
+# ----------------------------------------------------------------------
+# AsyncAdbDevice
+# ----------------------------------------------------------------------
+
+class AsyncAdbDevice(object):
+    """Coroutine versions of AdbDevice's methods.  Wraps an adb.AdbDevice."""
+    def __init__(self, device):
+        self.device = device
+        self.serial = device.serial
+
+    def __str__(self):
+        return "<AsyncAdbDevice: %s>" % (self.serial,)
+
+    def connect_and_send(self, cmd):
+        """Coroutine: connect to this device, send *cmd*, return sock."""
+        sock = yield adb_connect_and_send("host:transport:%s" % (self.device.devpath or self.serial,))
+        yield adb_send_command(sock, cmd)
+        raise Return(sock)
+
+    def shell(self, cmd, outf=None):
+        """Coroutine: run *cmd* in a remote shell.
+        Output is written to *outf*, or returned if there isn't one."""
+        sock = yield self.connect_and_send('shell:' + cmd)
+        datas = []
+        try:
+            while True:
+                data = yield sock.recv(65536)
+                if data == '': break
+                if outf is None: datas.append(data)
+                else:            outf.write(data)
+        finally:
+            sock.close()
+        raise Return(''.join(datas))
+
+    # Sync protocol
+
+    def open_sync(self):
+        """Coroutine: return a socket for the sync_* methods.  Pass it to close_sync when done."""
+        return self.connect_and_send('sync:')
+
+    def close_sync(self, sock):
+        try: yield sync_send_req(sock, 'QUIT', '')
+        except socket.error: pass
+        sock.close()
+
+    def sync_stat(self, sock, remote_file):
+        """Coroutine: return st_mode, st_size, st_mtime."""
+        yield sync_send_req(sock, 'STAT', remote_file)
+        _, mode, size, mtime = yield sync_recv_stat(sock)
+        raise Return((mode, size, mtime))
+
+    def sync_push(self, sock, local_file, remote_file):
+        """Coroutine: like AdbDevice.sync_push.  Each chunk is read only once
+        the last one has been handed to the kernel."""
+        mode = (yield self.sync_stat(sock, remote_file))[0]
+        if mode != 0 and stat.S_ISDIR(mode):
+            raise AdbError("Cannot push onto %s: is S_ISDIR" % remote_file)
+        st = os.stat(local_file)
+        if not stat.S_ISREG(st.st_mode):
+            raise AdbError("Cannot push %s: not S_ISREG" % local_file)
+        target = "%s,%d" % (remote_file, mode)
+        head = adb._SYNC_HDR.pack('SEND', len(target)) + target
+        with file(local_file, 'rb') as inf:
+            while True:
+                data = inf.read(adb.SYNC_DATA_MAX)
+                if not data: break
+                yield sock.sendall(head + adb._SYNC_HDR.pack('DATA', len(data)) + data)
+                head = ''
+        yield sock.sendall(head + adb._SYNC_HDR.pack('DONE', int(st.st_mtime)))
+        try:
+            yield sync_recv_status(sock)
+        except AdbError as e:
+            raise AdbError("Cannot push %s: %s" % (remote_file, e))
+
+    def sync_pull(self, sock, remote_file, local_file):
+        """Coroutine: like AdbDevice.sync_pull, for a filename."""
+        mode, _, mtime = yield self.sync_stat(sock, remote_file)
+        if mode == 0:
+            raise AdbError("Cannot pull %s: file does not exist" % remote_file)
+        if not stat.S_ISREG(mode):
+            raise AdbError("Cannot pull %s: not S_ISREG" % remote_file)
+        try: os.makedirs(os.path.dirname(local_file))
+        except OSError: pass
+
+        tmp_file = local_file + '.part'
+        try:
+            with file(tmp_file, 'wb') as outf:
+                yield sync_send_req(sock, 'RECV', remote_file)
+                while True:
+                    id, data = yield sync_recv_data(sock)
+                    if id == 'DONE': break
+                    outf.write(data)
+            try: os.unlink(local_file)
+            except OSError: pass
+            os.rename(tmp_file, local_file)
+            os.utime(local_file, (mtime, mtime))
+        finally:
+            try: os.unlink(tmp_file)
+            except OSError: pass
+
+    def sync_walk(self, sock, root):
+        return sync_walk(sock, root)
+
+    # Conveniences that use a sync connection of their own
+
+    def _with_sync(self, method, *args):
+        sock = yield self.open_sync()
+        try:
+            result = yield method(sock, *args)
+        finally:
+            yield self.close_sync(sock)
+        raise Return(result)
+
+    def push(self, local_file, remote_file):
+        """Coroutine: push one file."""
+        return self._with_sync(self.sync_push, local_file, remote_file)
+
+    def pull(self, remote_file, local_file):
+        """Coroutine: pull one file."""
+        return self._with_sync(self.sync_pull, remote_file, local_file)
+
+    def walk(self, root):
+        """Coroutine: return a list of (root, dirs, files), like AdbDevice.walk yields."""
+        return self._with_sync(self.sync_walk, root)
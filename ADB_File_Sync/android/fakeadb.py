@@ -0,0 +1,433 @@
+# -*- python -*-
+#
+# Copyright 2008 - 2015 Double Fine Productions
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#
+# A stand-in for the adb server and its devices, for testing and benchmarking
+# without a phone.  Each FakeDevice keeps its filesystem in a directory on the
+# host; shell commands run in the host's sh, with device paths rewritten.
+#
+#   dev = FakeDevice('/tmp/fakedev', latency=0.002, bandwidth=30e6)
+#   server = FakeAdbServer([dev]).start()
+#   adb.ADB_PORT = server.port
+#   ... use android.adb and android.rsync as usual ...
+#   server.stop()
+#
+# Speaks host:version, host:devices(-l), host:transport:, host-serial:*:get-state,
+# sync: (STAT, LIST, SEND, RECV, QUIT), shell:, and exec:sh with commands on stdin.
+#
+# Latency is charged per round trip: whenever the server has replied and then
+# has to wait for the client, rather than finding its next request already
+# there.  So pipelining pays off here the way it does on a real device.
+#
+
+import os
+import re
+import time
+import select
+import struct
+import socket
+import threading
+import subprocess
+import SocketServer
+
+from android.adb import SYNC_CODECS
+
+__all__ = ('FakeDevice', 'FakeAdbServer')
+
+SYNC_DATA_MAX = 64*1024
+# What a recent adbd reports, as far as the sync protocol goes, plus whichever
+# compression we have the modules for
+FEATURES = ('stat_v2', 'ls_v2', 'sendrecv_v2') + tuple(codec.feature for codec in SYNC_CODECS)
+
+# ----------------------------------------------------------------------
+# Devices
+# ----------------------------------------------------------------------
+
+class FakeDevice(object):
+    """A device whose files live under *root* on the host.
+
+    *latency* is seconds per round trip, *bandwidth* is bytes/sec each way
+    (None for unlimited).  If not *mtime_works*, pushed files keep the time they
+    were written, like /sdcard on many devices.  If not *exec_sh*, there's no
+    exec: service, like older devices.  *mounts* are the device directories
+    that exist at the start.  *features* are reported by host:features; pass
+    () for a device that only speaks the v1 sync protocol."""
+    def __init__(self, root, serial='fake0001', latency=0.0, bandwidth=None,
+                 mtime_works=True, exec_sh=True, mounts=('/sdcard', '/data/local/tmp'),
+                 features=FEATURES):
+        self.root = root.rstrip('/')
+        self.serial = serial
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.mtime_works = mtime_works
+        self.exec_sh = exec_sh
+        self.mounts = mounts
+        self.features = tuple(features)
+        self.lock = threading.Lock()
+        self.stats = dict.fromkeys(('connections', 'round_trips', 'requests', 'shells',
+                                    'bytes_in', 'bytes_out'), 0)
+        for m in mounts:
+            try: os.makedirs(self.host_path(m))
+            except OSError: pass
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def reset_stats(self):
+        with self.lock:
+            for key in self.stats:
+                self.stats[key] = 0
+
+    def host_path(self, path):
+        """Host filename for device path *path*."""
+        return self.root + '/' + path.lstrip('/')
+
+    def _to_host(self, cmd):
+        for m in self.mounts:
+            cmd = cmd.replace(m, self.host_path(m))
+        return cmd
+
+    def _from_host(self, out):
+        return out.replace(self.root + '/', '/')
+
+    def _transfer_time(self, nbytes):
+        if self.bandwidth:
+            time.sleep(nbytes / float(self.bandwidth))
+
+# ----------------------------------------------------------------------
+# Connections
+# ----------------------------------------------------------------------
+
+class _Conn(object):
+    """One client connection, with round trip accounting."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = ''
+        self.device = None
+        self.replied = False    # sent something since the last read from the client
+
+    def _wait_for_client(self):
+        if self.replied and self.device is not None:
+            self.replied = False
+            if not select.select([self.sock], [], [], 0)[0]:
+                self.device.count('round_trips')
+                time.sleep(self.device.latency)
+
+    def recv(self, n):
+        while len(self.buf) < n:
+            self._wait_for_client()
+            data = self.sock.recv(max(65536, n - len(self.buf)))
+            if not data:
+                raise EOFError
+            self.buf += data
+        data, self.buf = self.buf[:n], self.buf[n:]
+        return data
+
+    def send(self, data):
+        self.replied = True
+        if self.device is not None:
+            self.device.count('bytes_out', len(data))
+            self.device._transfer_time(len(data))
+        self.sock.sendall(data)
+
+    def okay(self):
+        self.send('OKAY')
+
+    def fail(self, msg):
+        self.send('FAIL%04x%s' % (len(msg), msg))
+
+    def reply(self, msg):
+        self.send('OKAY%04x%s' % (len(msg), msg))
+
+    def sync_fail(self, msg):
+        self.send('FAIL' + struct.pack('<I', len(msg)) + msg)
+
+
+class _Handler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = _Conn(self.request)
+        try:
+            self._serve(conn)
+        except (EOFError, socket.error):
+            pass
+        finally:
+            try: self.request.close()
+            except socket.error: pass
+
+    def _serve(self, conn):
+        server = self.server.fake
+        while True:
+            svc = conn.recv(int(conn.recv(4), 16))
+            if svc == 'host:version':
+                return conn.reply('%04x' % 32)
+            if svc in ('host:devices', 'host:devices-l'):
+                return conn.reply(''.join(
+                    '%s\tdevice usb:fake-%d product:fake model:Fake\n' % (d.serial, i)
+                    for (i, d) in enumerate(server.devices)))
+            m = re.match(r'host-serial:([^:]+):(.*)$', svc)
+            if m:
+                if server.find(m.group(1)) is None: return conn.fail('device not found')
+                if m.group(2) == 'get-state':       return conn.reply('device')
+                if m.group(2) == 'wait-for-device': return conn.send('OKAYOKAY')
+                if m.group(2) == 'features':
+                    return conn.reply(','.join(server.find(m.group(1)).features))
+                return conn.fail('unknown host service')
+            if svc.startswith('host:wait-for-'):
+                return conn.send('OKAYOKAY')        # adb sends two, for some reason
+            if svc.startswith('host:transport'):
+                if svc == 'host:transport-any': device = server.devices[0] if server.devices else None
+                else:                           device = server.find(svc.split(':', 2)[2])
+                if device is None:
+                    return conn.fail('device not found')
+                conn.device = device
+                device.count('connections')
+                conn.okay()
+                continue
+
+            device = conn.device
+            if device is None:
+                return conn.fail('unknown host service')
+            if svc == 'sync:':
+                conn.okay()
+                return _serve_sync(conn, device)
+            if svc == 'exec:sh' and device.exec_sh:
+                conn.okay()
+                return _serve_interactive_shell(conn, device)
+            if svc.startswith('shell:') or (svc.startswith('exec:') and device.exec_sh):
+                conn.okay()
+                return _serve_shell(conn, device, svc.split(':', 1)[1])
+            return conn.fail('closed')
+
+# ----------------------------------------------------------------------
+# Services
+# ----------------------------------------------------------------------
+
+def _serve_shell(conn, device, cmd):
+    device.count('shells')
+    device.count('requests')
+    proc = subprocess.Popen(['sh', '-c', device._to_host(cmd)], cwd=device.root,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+    conn.send(device._from_host(proc.communicate()[0]))
+
+
+def _serve_interactive_shell(conn, device):
+    """An sh reading commands from the connection, until the client closes it."""
+    device.count('shells')
+    # close_fds, or the shell holds on to everyone else's sockets, and they
+    # never see EOF
+    proc = subprocess.Popen(['sh'], cwd=device.root, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+    def _pump_out():
+        while True:
+            data = os.read(proc.stdout.fileno(), 65536)
+            if not data: break
+            try: conn.send(device._from_host(data))
+            except socket.error: break
+    pump = threading.Thread(target=_pump_out)
+    pump.daemon = True
+    pump.start()
+    data, conn.buf = conn.buf, ''
+    try:
+        while True:
+            if data:
+                device.count('requests')
+                proc.stdin.write(device._to_host(data))
+                proc.stdin.flush()
+            conn._wait_for_client()
+            data = conn.sock.recv(65536)
+            if not data: break
+    except (socket.error, IOError):
+        pass
+    try: proc.stdin.close()
+    except IOError: pass
+    proc.wait()
+    pump.join()
+
+
+def _serve_sync(conn, device):
+    while True:
+        id, n = struct.unpack('<4sI', conn.recv(8))
+        if id == 'QUIT':
+            return
+        path = conn.recv(n)
+        device.count('requests')
+        v2 = id in ('STA2', 'LST2', 'LIS2', 'SND2', 'RCV2')
+        if v2 and not _has_v2(device, id):
+            conn.sync_fail('unknown sync id %r' % id)
+            return
+        if id == 'STAT':
+            try: st = os.stat(device.host_path(path))
+            except OSError: conn.send(struct.pack('<4s3I', 'STAT', 0, 0, 0))
+            else: conn.send(struct.pack('<4s3I', 'STAT', st.st_mode, st.st_size & 0xffffffff,
+                                        int(st.st_mtime)))
+        elif id in ('STA2', 'LST2'):
+            stat_fn = os.stat if id == 'STA2' else os.lstat
+            try: st = stat_fn(device.host_path(path))
+            except OSError as e: conn.send(_STAT2.pack(id, e.errno, *(0,)*10))
+            else: conn.send(_stat2(id, st))
+        elif id in ('LIST', 'LIS2'):
+            _sync_list(conn, device, path, v2)
+        elif id in ('SEND', 'SND2'):
+            decompressor = None
+            if v2:
+                _, mode, flags = struct.unpack('<4sII', conn.recv(12))
+                codec = _codec(flags)
+                if flags and codec is None:
+                    conn.sync_fail('unsupported flags %#x' % flags)
+                    return
+                if codec is not None:
+                    decompressor = codec.decompressor()
+                path += ',%d' % mode
+            if not _sync_send(conn, device, path, decompressor):
+                return
+        elif id in ('RECV', 'RCV2'):
+            compressor = None
+            if v2:
+                _, flags = struct.unpack('<4sI', conn.recv(8))
+                codec = _codec(flags)
+                if flags and codec is None:
+                    conn.sync_fail('unsupported flags %#x' % flags)
+                    return
+                if codec is not None:
+                    compressor = codec.compressor()
+            _sync_recv(conn, device, path, compressor)
+        else:
+            conn.sync_fail('unknown sync id %r' % id)
+            return
+
+_STAT2 = struct.Struct('<4sIQQIIIIQqqq')
+
+def _stat2(id, st, name=None):
+    """Pack a STA2/LST2 reply, or with *name*, a DNT2."""
+    msg = _STAT2.pack(id, 0, st.st_dev, st.st_ino, st.st_mode, st.st_nlink, st.st_uid,
+                      st.st_gid, st.st_size, int(st.st_atime), int(st.st_mtime), int(st.st_ctime))
+    if name is not None:
+        msg += struct.pack('<I', len(name)) + name
+    return msg
+
+def _has_v2(device, id):
+    feature = {'STA2': 'stat_v2', 'LST2': 'stat_v2', 'LIS2': 'ls_v2'}.get(id, 'sendrecv_v2')
+    return feature in device.features
+
+def _codec(flags):
+    for codec in SYNC_CODECS:
+        if flags == codec.flag:
+            return codec
+    return None
+
+def _sync_list(conn, device, path, v2=False):
+    host = device.host_path(path)
+    try: names = ['.', '..'] + os.listdir(host)
+    except OSError: names = []
+    out = []
+    for name in names:
+        try: st = os.lstat(os.path.join(host, name))
+        except OSError: continue
+        if v2: out.append(_stat2('DNT2', st, name))
+        else:  out.append(struct.pack('<4s4I', 'DENT', st.st_mode, st.st_size & 0xffffffff,
+                                      int(st.st_mtime), len(name)) + name)
+    if v2: out.append(_STAT2.pack('DONE', *(0,)*11) + struct.pack('<I', 0))
+    else:  out.append(struct.pack('<4s4I', 'DONE', 0, 0, 0, 0))
+    conn.send(''.join(out))
+
+def _sync_send(conn, device, path, decompressor=None):
+    """Receive a file.  Returns False if the session is over."""
+    path, mode = path.rsplit(',', 1)
+    host = device.host_path(path)
+    try: os.makedirs(os.path.dirname(host))
+    except OSError: pass
+    err = None
+    try: outf = open(host, 'wb')
+    except IOError as e:
+        outf, err = None, str(e)
+    while True:
+        id, size = struct.unpack('<4sI', conn.recv(8))
+        if id == 'DONE':
+            mtime = size
+            break
+        data = conn.recv(size)
+        device.count('bytes_in', size)
+        device._transfer_time(size)
+        if decompressor is not None:
+            data = decompressor.decompress(data)
+        if outf is not None:
+            outf.write(data)
+    if outf is not None:
+        outf.close()
+        if device.mtime_works:
+            os.utime(host, (mtime, mtime))
+    if err:
+        # adbd gives up on the whole sync session after a failed SEND.  Let
+        # the FAIL get through before the connection goes away.
+        conn.sync_fail(err)
+        conn.sock.shutdown(socket.SHUT_WR)
+        while conn.sock.recv(65536): pass
+        return False
+    conn.send(struct.pack('<4sI', 'OKAY', 0))
+    return True
+
+def _sync_recv(conn, device, path, compressor=None):
+    try: inf = open(device.host_path(path), 'rb')
+    except IOError as e:
+        return conn.sync_fail(str(e))
+    with inf:
+        while True:
+            data = out = inf.read(SYNC_DATA_MAX)
+            if compressor is not None:
+                out = compressor.compress(data) if data else compressor.flush()
+            for i in xrange(0, len(out), SYNC_DATA_MAX):
+                piece = out[i:i+SYNC_DATA_MAX]
+                conn.send(struct.pack('<4sI', 'DATA', len(piece)) + piece)
+            if not data: break
+    conn.send(struct.pack('<4sI', 'DONE', 0))
+
+# ----------------------------------------------------------------------
+# Server
+# ----------------------------------------------------------------------
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        pass            # clients hanging up is business as usual
+
+
+class FakeAdbServer(object):
+    """Serves *devices* on localhost:*port* (0 picks a free port; see self.port)."""
+    def __init__(self, devices, port=0):
+        self.devices = list(devices)
+        self._server = _Server(('localhost', port), _Handler)
+        self._server.fake = self
+        self.port = self._server.server_address[1]
+        self._thread = None
+
+    def find(self, ident):
+        """Return the device with serial or devpath *ident*, or None."""
+        for (i, d) in enumerate(self.devices):
+            if ident in (d.serial, 'usb:fake-%d' % i):
+                return d
+        return None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
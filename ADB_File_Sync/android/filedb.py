@@ -0,0 +1,452 @@
+# -*- python -*-
+#
+# Copyright 2008 - 2015 Double Fine Productions
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#
+# The rsync file db, stored on the device as a snapshot plus a journal.
+#
+# The db is a dict mapping canonical relative pathname -> (mtime, size).
+# In memory it's a DbDict, which acts like one but takes a fraction of the
+# space for big trees.
+# On the device it lives in remote_folder as:
+#
+#   files.db        The base snapshot.  Header, then a zlib'd body of
+#                   all the mtimes, all the sizes, and the NUL-joined keys.
+#   files.db.<n>    Journal segments 1, 2, ... on top of that base.
+#                   Each one is a run of checksummed set/delete records.
+#
+# The sync protocol can't append to a file, so each checkpoint pushes a new
+# (small) segment instead, and an occasional compaction folds them all into
+# a new base.  Every base gets a random id, and segments carry the id of the
+# base they belong to, so stale segments left behind by a compaction are
+# never applied to the wrong base.
+#
+# Anything we can't read back -- a truncated segment, a bad record, a
+# mangled base -- just ends the load there.  That's safe, because the db may
+# hold a subset of what's on the device, but never a superset.
+#
+
+import os
+import re
+import zlib
+import struct
+import pickle
+from array import array
+from itertools import izip
+from cStringIO import StringIO
+
+import android.adb as adb
+from android.utils import posixjoin, shell_quote
+from android import trace
+
+__all__ = ('FileDb', 'DbDict', 'is_db_file')
+
+_BASE_NAME = 'files.db'
+_LEGACY_NAME = 'files.pickle'
+
+_BASE_MAGIC = 'RSDB'
+_JOURNAL_MAGIC = 'RSDJ'
+
+_BASE_HDR = struct.Struct('<4sII')      # magic, base id, count
+_JOURNAL_HDR = struct.Struct('<4sI')    # magic, base id
+_RECORD = struct.Struct('<IcHdq')       # crc, op, keylen, mtime, size; followed by key
+
+MAX_SEGMENTS = 64           # compact once there are this many journal segments...
+COMPACT_MIN_RECORDS = 1000  # ...or this many records, and more than half the db
+
+_db_file_re = re.compile(r'^(?:%s(?:\.\d+|\.tmp)?|%s)$' % (
+    re.escape(_BASE_NAME), re.escape(_LEGACY_NAME)))
+
+def is_db_file(name):
+    """Return True if *name* is one of the files the db keeps in remote_folder."""
+    return _db_file_re.match(name) is not None
+
+
+class _DbDir(object):
+    """One directory's entries in a DbDict."""
+    __slots__ = ('rows', 'mtimes', 'sizes', 'free')
+
+    def __init__(self):
+        self.rows = {}          # name -> its index in mtimes and sizes
+        self.mtimes = array('d')
+        self.sizes = array('d') # exact up to 2**53; Python 2's array has no 'q'
+        self.free = []          # indexes left by removed names, for reuse
+
+
+class DbDict(object):
+    """A dict of canonical relative pathname -> (mtime, size), like the db,
+    laid out for trees with millions of files.  Each directory is stored once,
+    with a dict of the names in it, and the mtimes and sizes go in arrays, so
+    there's no full path, tuple, float or long per entry.  Keys and values are
+    made as they're read.  Only the dict methods the db needs are here."""
+    __slots__ = ('dirs', 'count')
+
+    def __init__(self, items=()):
+        self.dirs = {}          # directory ('' for the top) -> _DbDir
+        self.count = 0
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        # __setitem__, unrolled, as this is how a whole db gets loaded
+        dirs = self.dirs
+        d = dirname = None
+        for (key, (mtime, size)) in items:
+            (k_dirname, _, name) = key.rpartition('/')
+            if k_dirname != dirname:
+                dirname = k_dirname
+                d = dirs.get(dirname)
+                if d is None:
+                    d = dirs[dirname] = _DbDir()
+            row = d.rows.get(name)
+            if row is None:
+                d.rows[name] = len(d.mtimes)
+                d.mtimes.append(mtime)
+                d.sizes.append(size)
+            else:
+                d.mtimes[row] = mtime
+                d.sizes[row] = size
+        self.count = sum(len(d.rows) for d in dirs.itervalues())
+
+    def _find(self, key):
+        (dirname, _, name) = key.rpartition('/')
+        d = self.dirs.get(dirname)
+        if d is None:
+            return None, None
+        return d, d.rows.get(name)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return self._find(key)[1] is not None
+
+    def get(self, key, default=None):
+        (d, row) = self._find(key)
+        if row is None:
+            return default
+        return (d.mtimes[row], int(d.sizes[row]))
+
+    def __getitem__(self, key):
+        (d, row) = self._find(key)
+        if row is None:
+            raise KeyError(key)
+        return (d.mtimes[row], int(d.sizes[row]))
+
+    def __setitem__(self, key, value):
+        (mtime, size) = value
+        (dirname, _, name) = key.rpartition('/')
+        d = self.dirs.get(dirname)
+        if d is None:
+            d = self.dirs[dirname] = _DbDir()
+        row = d.rows.get(name)
+        if row is not None:
+            d.mtimes[row] = mtime
+            d.sizes[row] = size
+        elif d.free:
+            row = d.rows[name] = d.free.pop()
+            d.mtimes[row] = mtime
+            d.sizes[row] = size
+            self.count += 1
+        else:
+            d.rows[name] = len(d.mtimes)
+            d.mtimes.append(mtime)
+            d.sizes.append(size)
+            self.count += 1
+
+    def pop(self, key, *default):
+        (dirname, _, name) = key.rpartition('/')
+        d = self.dirs.get(dirname)
+        row = None if d is None else d.rows.pop(name, None)
+        if row is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = (d.mtimes[row], int(d.sizes[row]))
+        self.count -= 1
+        if d.rows:
+            d.free.append(row)
+        else:
+            del self.dirs[dirname]
+        return value
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def listdir(self, dirname):
+        """Return a dict mapping each name in *dirname* -> (mtime, size).
+        Cheaper than a lookup per key, for going through a directory at a time."""
+        d = self.dirs.get(dirname)
+        if d is None:
+            return {}
+        mtimes, sizes = d.mtimes, d.sizes
+        return dict( (name, (mtimes[row], int(sizes[row]))) for (name, row) in d.rows.iteritems() )
+
+    def update_dir(self, dirname, entries):
+        """Set each name in *dirname* -> (mtime, size) from the dict *entries*."""
+        if not entries:
+            return
+        d = self.dirs.get(dirname)
+        if d is None:
+            # All new, so it can be built in one go
+            d = self.dirs[dirname] = _DbDir()
+            names, values = entries.keys(), entries.values()    # in the same order
+            d.rows = dict(izip(names, xrange(len(names))))
+            d.mtimes = array('d', [v[0] for v in values])
+            d.sizes = array('d', [v[1] for v in values])
+            self.count += len(names)
+            return
+        for (name, (mtime, size)) in entries.iteritems():
+            row = d.rows.get(name)
+            if row is not None:
+                d.mtimes[row] = mtime
+                d.sizes[row] = size
+                continue
+            if d.free:
+                row = d.rows[name] = d.free.pop()
+                d.mtimes[row] = mtime
+                d.sizes[row] = size
+            else:
+                d.rows[name] = len(d.mtimes)
+                d.mtimes.append(mtime)
+                d.sizes.append(size)
+            self.count += 1
+
+    def changes_from(self, old):
+        """Yield (key, (mtime, size)) for each entry that's new or different
+        from DbDict *old*, and (key, None) for each one that's only in *old*."""
+        for (dirname, d) in self.dirs.iteritems():
+            prefix = dirname + '/' if dirname else ''
+            o = old.dirs.get(dirname)
+            for (name, row) in d.rows.iteritems():
+                o_row = None if o is None else o.rows.get(name)
+                if (o_row is None or o.mtimes[o_row] != d.mtimes[row] or
+                    o.sizes[o_row] != d.sizes[row]):
+                    yield (prefix + name, (d.mtimes[row], int(d.sizes[row])))
+        for (dirname, o) in old.dirs.iteritems():
+            prefix = dirname + '/' if dirname else ''
+            d = self.dirs.get(dirname)
+            for name in o.rows:
+                if d is None or name not in d.rows:
+                    yield (prefix + name, None)
+
+    def iteritems(self):
+        for (dirname, d) in self.dirs.iteritems():
+            prefix = dirname + '/' if dirname else ''
+            mtimes, sizes = d.mtimes, d.sizes
+            for (name, row) in d.rows.iteritems():
+                yield (prefix + name, (mtimes[row], int(sizes[row])))
+
+    def iterkeys(self):
+        for (dirname, d) in self.dirs.iteritems():
+            prefix = dirname + '/' if dirname else ''
+            for name in d.rows:
+                yield prefix + name
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def items(self):
+        return list(self.iteritems())
+
+
+def _pack_base(base_id, dct):
+    keys, mtimes, sizes = [], [], []
+    for (k, (mtime, size)) in dct.iteritems():
+        keys.append(k)
+        mtimes.append(mtime)
+        sizes.append(size)
+    n = len(keys)
+    body = ''.join((
+        struct.pack('<%dd' % n, *mtimes),
+        struct.pack('<%dq' % n, *sizes),
+        '\0'.join(keys)))
+    return _BASE_HDR.pack(_BASE_MAGIC, base_id, n) + zlib.compress(body, 1)
+
+def _unpack_base(data):
+    """Return (base_id, DbDict).  Raise ValueError if *data* is damaged."""
+    try:
+        magic, base_id, n = _BASE_HDR.unpack_from(data)
+        if magic != _BASE_MAGIC:
+            raise ValueError("not a db snapshot")
+        body = zlib.decompress(data[_BASE_HDR.size:])
+        mtimes = struct.unpack_from('<%dd' % n, body)
+        sizes = struct.unpack_from('<%dq' % n, body, 8*n)
+    except (zlib.error, struct.error) as e:
+        raise ValueError(str(e))
+    keys = body[16*n:].split('\0') if n else []
+    if len(keys) != n:
+        raise ValueError("wrong number of keys")
+    return base_id, DbDict(izip(keys, izip(mtimes, sizes)))
+
+def _pack_record(key, value):
+    if value is None: op, mtime, size = '-', 0, 0
+    else:             op, (mtime, size) = '+', value
+    rest = _RECORD.pack(0, op, len(key), mtime, size)[4:] + key
+    return struct.pack('<I', zlib.crc32(rest) & 0xffffffff) + rest
+
+def _apply_journal(data, base_id, dct):
+    """Apply a segment's records to *dct*, returning how many there were.
+    Return None if the segment belongs to some other base.
+    Raise ValueError if it was cut short; the records before that still count."""
+    if len(data) < _JOURNAL_HDR.size:
+        return None
+    magic, seg_base_id = _JOURNAL_HDR.unpack_from(data)
+    if magic != _JOURNAL_MAGIC or seg_base_id != base_id:
+        return None
+    n, pos = 0, _JOURNAL_HDR.size
+    while pos < len(data):
+        end = pos + _RECORD.size
+        if end > len(data):
+            raise ValueError("truncated record")
+        crc, op, keylen, mtime, size = _RECORD.unpack_from(data, pos)
+        if end + keylen > len(data):
+            raise ValueError("truncated record")
+        if zlib.crc32(buffer(data, pos+4, end+keylen-pos-4)) & 0xffffffff != crc:
+            raise ValueError("bad checksum")
+        key = data[end:end+keylen]
+        if op == '+':   dct[key] = (mtime, size)
+        elif op == '-': dct.pop(key, None)
+        else:           raise ValueError("bad record")
+        n += 1
+        pos = end + keylen
+    return n
+
+
+class FileDb(object):
+    """The file db for one remote_folder on one device.
+
+    load() it once, then checkpoint() whenever the caller's idea of the db
+    should be made durable.  Only the entries that changed since the last
+    checkpoint get uploaded."""
+    def __init__(self, device, remote_folder):
+        self.device = device
+        self.remote_folder = remote_folder
+        self.entries = DbDict() # the device's copy, as of the last load/checkpoint
+        self.base_id = 0
+        self.segments = 0       # journal segments on top of the base
+        self.records = 0        # records in those segments
+        self.needs_compact = True
+
+    def _path(self, name):
+        return posixjoin(self.remote_folder, name)
+
+    def _segment_path(self, n):
+        return self._path('%s.%d' % (_BASE_NAME, n))
+
+    def _pull(self, sock, path):
+        outf = StringIO()
+        self.device.sync_pull(sock, path, outf)
+        return outf.getvalue()
+
+    def load(self):
+        """Fetch the db from the device, returning a DbDict (which is self.entries).
+        A missing or unreadable db comes back empty, or partial."""
+        self.entries = DbDict()
+        self.segments = self.records = 0
+        self.needs_compact = True
+        try:
+            with self.device.sync_transaction() as sock:
+                try:
+                    data = self._pull(sock, self._path(_BASE_NAME))
+                except adb.AdbError:
+                    self._load_legacy(sock)
+                    return self.entries
+                try:
+                    self.base_id, self.entries = _unpack_base(data)
+                except ValueError:
+                    return self.entries
+                self.needs_compact = False
+                while True:
+                    try:
+                        data = self._pull(sock, self._segment_path(self.segments+1))
+                    except adb.AdbError:
+                        break
+                    try:
+                        n = _apply_journal(data, self.base_id, self.entries)
+                    except ValueError:
+                        # Anything we wrote after this would never be read back
+                        self.needs_compact = True
+                        break
+                    if n is None:
+                        break           # left over from an older base
+                    self.segments += 1
+                    self.records += n
+        except adb.AdbError:
+            pass
+        return self.entries
+
+    def _load_legacy(self, sock):
+        """Pick up the files.pickle written by older versions of rsync."""
+        try:
+            self.entries = DbDict(pickle.loads(self._pull(sock, self._path(_LEGACY_NAME))))
+        except Exception:
+            self.entries = DbDict()
+
+    def checkpoint(self, sock, dct, keys=None):
+        """Make the device's copy of the db match *dct*.
+
+        If *keys* is given, only those entries may have changed since the last
+        checkpoint, and only they are looked at.  Otherwise *dct* is compared
+        in full against the last checkpoint, and adopted as self.entries so
+        later checkpoints can go by *keys*.
+        *sock* must be a sync socket that's not in the middle of anything."""
+        if keys is None:
+            old = self.entries
+            if isinstance(dct, DbDict) and isinstance(old, DbDict):
+                changes = list(dct.changes_from(old))
+            else:
+                changes = [(k, v) for (k, v) in dct.iteritems() if old.get(k) != v]
+                changes.extend((k, None) for k in old if k not in dct)
+            self.entries = dct
+        else:
+            changes = [(k, dct.get(k)) for k in keys]
+            if self.entries is not dct:
+                for (k, v) in changes:
+                    if v is None: self.entries.pop(k, None)
+                    else:         self.entries[k] = v
+
+        with trace.phase('db checkpoint'):
+            if self.needs_compact or self._should_compact(len(changes)):
+                self._compact(sock)
+            elif changes:
+                self._append(sock, changes)
+
+    def _should_compact(self, nchanges):
+        if self.segments + 1 >= MAX_SEGMENTS:
+            return True
+        records = self.records + nchanges
+        return records > COMPACT_MIN_RECORDS and records > len(self.entries) // 2
+
+    def _append(self, sock, changes):
+        data = _JOURNAL_HDR.pack(_JOURNAL_MAGIC, self.base_id) + ''.join(
+            _pack_record(k, v) for (k, v) in changes)
+        self.device.sync_push(sock, StringIO(data), self._segment_path(self.segments+1))
+        self.segments += 1
+        self.records += len(changes)
+
+    def _compact(self, sock):
+        """Write self.entries as a new base, and drop the journal."""
+        base_id = struct.unpack('<I', os.urandom(4))[0]
+        tmp, base = self._path(_BASE_NAME + '.tmp'), self._path(_BASE_NAME)
+        self.device.sync_push(sock, StringIO(_pack_base(base_id, self.entries)), tmp)
+        # Swap it in.  Old segments have the wrong base id, so it doesn't
+        # matter if some of them survive the rm.
+        out = self.device.simple_shell("mv %s %s && echo OKAY" % (shell_quote(tmp), shell_quote(base)))
+        if 'OKAY' not in out:
+            raise adb.AdbError("Could not write %s: %s" % (base, out.strip()))
+        self.base_id = base_id
+        self.segments = self.records = 0
+        self.needs_compact = False
+        self.device.simple_shell("rm %s/%s.[0-9]* %s" % (
+            shell_quote(self.remote_folder), _BASE_NAME, shell_quote(self._path(_LEGACY_NAME))))
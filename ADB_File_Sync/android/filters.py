@@ -0,0 +1,142 @@
+# -*- python -*-
+#
+# Copyright 2008 - 2015 Double Fine Productions
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#
+# Include/exclude rules for rsync, in the style of rsync's own:
+#
+#   + keep.o        include keep.o, in any directory
+#   - *.o           exclude all the other *.o files
+#   - .git/         a trailing / only matches directories
+#   - /build/       a leading / only matches at the top of the tree
+#   - art/*.psd     a / anywhere else matches the end of the path: x/art/y.psd
+#   - tmp/**        ** matches across /, * and ? don't
+#
+# The first rule that matches decides; nothing matching means included.  A
+# rule with no + or - excludes.  Matching ignores case, like the rest of rsync.
+# An excluded directory is never descended into, so nothing in it can be
+# included again.
+#
+# All the rules are compiled into one regular expression, so checking a
+# name is one match however many rules there are.  Where find(1) can match
+# what an exclude rule does, find_prunes() hands it to the device, so the
+# excluded directories aren't even listed there.
+#
+
+import re
+
+__all__ = ('Filter',)
+
+
+def _translate(pat):
+    """Regular expression for glob *pat*."""
+    i, n, out = 0, len(pat), []
+    while i < n:
+        c = pat[i]
+        i += 1
+        if c == '*':
+            if i < n and pat[i] == '*':
+                out.append('.*')
+                i += 1
+            else:
+                out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            j = i
+            if j < n and pat[j] in '!^': j += 1
+            if j < n and pat[j] == ']':  j += 1     # []] and [!]] mean a literal ]
+            j = pat.find(']', j)
+            if j < 0:
+                out.append(re.escape(c))
+                continue
+            cls = pat[i:j]
+            if cls[0] in '!^':
+                cls = '^' + cls[1:]
+            out.append('[%s]' % cls.replace('\\', '\\\\'))
+            i = j + 1
+        else:
+            out.append(re.escape(c))
+    return ''.join(out)
+
+
+class Filter(object):
+    """Compiled include/exclude *rules*.  See the top of this file."""
+    def __init__(self, rules):
+        self.rules = []         # (include, pattern) in order
+        self.parsed = []        # (include, lowercased pattern, anchored, dir_only) in order
+        alts = []
+        for rule in rules:
+            rule = rule.strip()
+            if not rule or rule.startswith('#'):
+                continue
+            include = False
+            if rule[:2] in ('+ ', '- '):
+                include, rule = rule[0] == '+', rule[2:].strip()
+            pat = rule.lower()
+            dir_only = pat.endswith('/')
+            pat = pat.rstrip('/')
+            if pat.startswith('/'): prefix, pat = '', pat.lstrip('/')
+            else:                   prefix = '(?:.*/)?'
+            self.parsed.append( (include, pat, not prefix, dir_only) )
+            # Directories are matched with a / on the end
+            alts.append('(%s%s%s)' % (prefix, _translate(pat), '/' if dir_only else '/?'))
+            self.rules.append( (include, rule) )
+        self.re = re.compile('^(?:%s)$' % '|'.join(alts), re.DOTALL) if alts else None
+
+    def __repr__(self):
+        return '<Filter %s>' % ', '.join('%s %s' % ('+-'[not inc], pat) for (inc, pat) in self.rules)
+
+    def excluded(self, rel, is_dir):
+        """Return True if the rules exclude *rel*, a path relative to the top
+        of the tree.  Only *rel* itself is looked at, not its parents."""
+        if self.re is None:
+            return False
+        m = self.re.match(rel.lower() + '/' if is_dir else rel.lower())
+        return m is not None and not self.rules[m.lastindex - 1][0]
+
+    def excludes(self, rel, is_dir):
+        """Like excluded(), but also True if any parent of *rel* is excluded."""
+        parts = rel.split('/')
+        for i in xrange(1, len(parts)):
+            if self.excluded('/'.join(parts[:i]), True):
+                return True
+        return self.excluded(rel, is_dir)
+
+    def prune(self, rel_dir, dirs, files):
+        """Return (dirs, files) without what's excluded.  *dirs* and *files*
+        are the dirents in directory *rel_dir* ('' for the top)."""
+        if self.re is None:
+            return dirs, files
+        prefix = rel_dir + '/' if rel_dir else ''
+        return ([de for de in dirs if not self.excluded(prefix + de.name, True)],
+                [de for de in files if not self.excluded(prefix + de.name, False)])
+
+    def find_prunes(self):
+        """Return find(1) tests for what the device can leave out of its
+        listing: (test, pattern, dir_only), with test '-iname' or '-ipath'
+        (relative to '.').  Only exclude rules ahead of every include rule
+        qualify, and only where find matches no more than the rule does, so
+        prune() still has the last word."""
+        prunes = []
+        for (include, pat, anchored, dir_only) in self.parsed:
+            if include:
+                break
+            if '/' not in pat and not anchored:
+                # One name, in any directory; -iname's * stops at / like ours
+                prunes.append( ('-iname', pat.replace('**', '*'), dir_only) )
+            elif not any(c in pat.replace('**', '') for c in '*?['):
+                # find's * crosses /, like our **; nothing else to translate
+                prunes.append( ('-ipath', ('./' if anchored else '*/') + pat.replace('**', '*'),
+                                dir_only) )
+        return prunes
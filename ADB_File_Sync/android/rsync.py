@@ -29,21 +29,52 @@
 #   Your modification will not be detected, and the files will not be
 #   removed or re-copied until you run once in normal mode.
 #
+# - If you use a scan cache, a file modified in place (rather than written
+#   to a new name and renamed over, or deleted and recreated) doesn't change
+#   its directory's mtime, so it will not be noticed.  Pass rescan=True after
+#   doing that.
+#
+# In streaming mode, new files are pushed while the comparison is still
+# running.  Files the db has an entry for, and files that a removal has to
+# make room for, still wait until the db has been checkpointed and the
+# removals are done, so the assumptions above hold even if the run is
+# interrupted.
+#
 
 import os
+import sys
 import stat
 import time
-import pickle
-from cStringIO import StringIO
-from itertools import izip
+import heapq
+import Queue
+import cPickle
+import fnmatch
+import hashlib
+import threading
+from array import array
+from itertools import izip, chain
 
 import android.adb as adb
 from android.utils import posixjoin
 from android.progress import progress
+from android.filedb import FileDb, DbDict, is_db_file
+from android.filters import Filter
+from android import trace
+from android import watch
+
+try:
+    from scandir import scandir         # optional; saves a stat per entry on Windows
+except ImportError:
+    scandir = getattr(os, 'scandir', None)
 
-__all__ = ('rsync',)
+__all__ = ('rsync', 'rsync_many', 'rsync_pull', 'rsync_watch')
 
-_DB_NAME = 'files.pickle'
+LOCAL_WALK_THREADS = 8      # directories listed at once by _local_walk
+LOCAL_WALK_AHEAD = 256      # directories _local_walk lists ahead of its caller, at most
+WATCH_DEBOUNCE = 0.5        # rsync_watch waits for this long without changes before pushing
+ETA_FILE_COST = 64*1024     # what a file costs on top of its size, in bytes' worth of time, for the ETA
+ORDERS = (None, 'size', 'interleave')   # see rsync()
+QUEUE_AHEAD = 256           # jobs per stream _parallel_sync queues ahead; sync_push_many holds up to 3 windows
 
 # ----------------------------------------------------------------------
 # Little utils
@@ -75,37 +106,62 @@ def _plural(n, noun):
 # Helper for calculating bytes/sec
 class TimeEstimator(object):
     """Helper for estimating the time t at which a time-changing value
-    reaches some final value."""
-    def __init__(self, total, decay_time=10.0):
+    reaches some final value.
+
+    The value can also be made of items (files, say) that each cost
+    *item_cost* on top of their size, so a run of small items doesn't make
+    the estimate swing away from what a run of big ones does."""
+    def __init__(self, total, decay_time=10.0, count=0, item_cost=0):
         """*decay_time* is the time taken for the smoothed value to
         exponentially decay 90% of the way towards the instantaneous value.
-        Think of it as an averaging window."""
+        Think of it as an averaging window.  *count* is the number of items
+        in *total*."""
         self.decay_time = decay_time
         self.t = time.time()
         self.v = 0              # current value
         self.v1 = total         # final value
+        self.n = 0              # items so far
+        self.n1 = count         # items in total
+        self.item_cost = item_cost
         self.dvdt = 1           # smoothed with iir filter
+        self.dwdt = 1           # same, for the value plus item costs
 
-    def increment(self, dv):
+    def increment(self, dv, dn=0):
         """Return (progress_pct, eta_seconds)"""
-        if dv > 0:
+        if dv > 0 or dn > 0:
             t = time.time()
-            dt = t - self.t
+            dt = max(t - self.t, 1e-6)
             self.t = t
             self.v += dv
+            self.n += dn
             k = 0.1 ** (dt / self.decay_time)
             self.dvdt = k * self.dvdt + (1-k) * dv/dt
-        progress_pct = (1+self.v*100)//(1+self.v1)
-        return (progress_pct, (self.v1-self.v)/self.dvdt)
-
+            self.dwdt = k * self.dwdt + (1-k) * (dv + dn*self.item_cost)/dt
+        w = self.v + self.n*self.item_cost
+        w1 = self.v1 + self.n1*self.item_cost
+        progress_pct = (1+w*100)//(1+w1)
+        return (progress_pct, (w1-w)/self.dwdt)
 
-def _local_walk(root, warning):
-    """Walk local fs like os.walk,
-    but return info in the same form as device.walk"""
-    names = os.listdir(root)
 
+def _list_dir(root, warning):
+    """Return (dirs, files) for a local directory, as lists of dirent."""
     dirs, files = [], []
-    for name in names:
+    if scandir is not None:
+        for entry in scandir(root):
+            # d_type answers is_dir/is_file without a stat, so things that
+            # are neither (sockets, fifos, ...) are skipped for free
+            try:
+                if entry.is_dir():    lst = dirs
+                elif entry.is_file(): lst = files
+                else:                 continue
+                st = entry.stat()
+            except OSError:
+                warning("Unreadable: %s" % posixjoin(root, entry.name))
+                continue
+            lst.append(adb.dirent(st.st_mode, st.st_size, st.st_mtime, entry.name))
+        return dirs, files
+
+    for name in os.listdir(root):
         full = posixjoin(root,name)
         try: st = os.stat(full)
         except OSError:
@@ -115,44 +171,297 @@ def _local_walk(root, warning):
             dirs.append(adb.dirent(st.st_mode, st.st_size, st.st_mtime, name))
         elif stat.S_ISREG(st.st_mode):
             files.append(adb.dirent(st.st_mode, st.st_size, st.st_mtime, name))
+    return dirs, files
 
-    yield root, dirs, files
 
-    for subdir in dirs:
-        for tup in _local_walk(posixjoin(root, subdir.name), warning):
+def _local_walk(root, warning, list_dir=_list_dir, threads=LOCAL_WALK_THREADS, prune=None,
+                ahead=LOCAL_WALK_AHEAD):
+    """Walk local fs like os.walk,
+    but return info in the same form as device.walk
+
+    Directories are listed by a pool of *threads*, running up to *ahead*
+    directories ahead of the caller, but come out in the same order as a plain
+    recursive walk.  As with os.walk, the caller may reorder or remove dirs
+    before going on.  *list_dir* is called (from those threads) to list each
+    directory.  If *prune* (see _pruner), what it drops is never walked or
+    returned."""
+    results = {}                # path -> (dirs, files), or exc_info
+    cond = threading.Condition()
+    # Directories waiting to be listed.  A directory's key is the indexes that
+    # lead to it from *root*, so listing in key order follows the walk, as long
+    # as the caller doesn't reorder anything.
+    pending = { root: () }      # path -> key
+    todo = [ ((), root) ]       # heap of (key, path); paths no longer pending are skipped
+    busy = set()                # paths being listed
+    gone = set()                # paths being listed that the caller has dropped
+    state = { 'wanted': root, 'stop': False }
+
+    def _take(path):
+        busy.add(path)
+        return (pending.pop(path), path)
+
+    def _next():
+        # The next directory to list, once there's room for it.  The one _walk
+        # is waiting for always goes first, room or not.
+        with cond:
+            while not state['stop']:
+                if state['wanted'] in pending:
+                    return _take(state['wanted'])
+                if len(results) + len(busy) < ahead:
+                    while todo and todo[0][1] not in pending:
+                        heapq.heappop(todo)
+                    if todo:
+                        return _take(heapq.heappop(todo)[1])
+                cond.wait(1.0)
+            return None
+
+    def _forget(path):
+        # Called with cond held
+        if path in pending:
+            del pending[path]
+        elif path in busy:
+            gone.add(path)
+        elif path in results:
+            result = results.pop(path)
+            if len(result) == 2:
+                for subdir in result[0]:
+                    _forget(posixjoin(path, subdir.name))
+
+    def _worker():
+        while True:
+            item = _next()
+            if item is None:
+                return
+            (key, path) = item
+            try:
+                result = list_dir(path, warning)
+                if prune is not None:
+                    result = prune(path, *result)
+            except Exception:
+                result = sys.exc_info()
+            with cond:
+                busy.discard(path)
+                if path in gone:
+                    gone.discard(path)
+                    continue
+                results[path] = result
+                if len(result) == 2:
+                    for (i, subdir) in enumerate(result[0]):
+                        sub = posixjoin(path, subdir.name)
+                        pending[sub] = key + (i,)
+                        heapq.heappush(todo, (key + (i,), sub))
+                cond.notify_all()
+
+    def _walk(path):
+        with cond:
+            if path not in results and path not in busy and path not in pending:
+                pending[path] = ()      # one the caller added
+            state['wanted'] = path
+            cond.notify_all()
+            while path not in results:
+                cond.wait(1.0)
+            result = results.pop(path)
+            cond.notify()       # there's room for one more
+        if len(result) == 3:
+            raise result[0], result[1], result[2]
+        dirs, files = result
+        listed = [subdir.name for subdir in dirs]
+        yield path, dirs, files
+        kept = set(subdir.name for subdir in dirs)
+        with cond:
+            for name in listed:
+                if name not in kept:
+                    _forget(posixjoin(path, name))
+        for subdir in dirs:
+            for tup in _walk(posixjoin(path, subdir.name)):
+                yield tup
+
+    workers = [threading.Thread(target=_worker) for i in xrange(max(1, threads))]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    try:
+        for tup in _walk(root):
             yield tup
+    finally:
+        with cond:
+            state['stop'] = True
+            cond.notify_all()
+        for w in workers:
+            w.join()
 
 
-# ----------------------------------------------------------------------
-# db stuff
-# ----------------------------------------------------------------------
+def _local_scan(root, warning, cache=None, prune=None):
+    """Scan the whole local tree, for replaying with _scan_walk.
+    Returns a dict mapping each directory to its (dirs, files), with *files*
+    a DirentList, as they're the bulk of it.
+
+    *cache* is a dict mapping directory -> (mtime, dirs, files), left over from
+    an earlier scan, and is brought up to date.  A directory whose mtime
+    matches is taken from it without listing or stat'ing what's inside.
+    *prune* is as for _local_walk; the cache keeps what it drops, so a
+    later scan with other filters still works."""
+    if cache is None:
+        return dict( (r, (d, adb.DirentList(f))) for (r, d, f) in _local_walk(root, warning, prune=prune) )
+
+    # mtime granularity can be coarse, so don't vouch for anything that
+    # might still have been changing while we looked at it.
+    t_trust = time.time() - 2
+    def _cached_list_dir(path, warning):
+        try: mtime = os.stat(path).st_mtime
+        except OSError: mtime = None
+        hit = cache.get(path)
+        if hit is not None and mtime is not None and hit[0] == mtime:
+            return hit[1], hit[2]
+        dirs, files = _list_dir(path, warning)
+        files = adb.DirentList(files)
+        cache[path] = ((mtime if mtime < t_trust else None), dirs, files)
+        return dirs, files
+
+    # Without a prune, the files come straight from the cache, so they're shared
+    scan = dict( (r, (d, f if isinstance(f, adb.DirentList) else adb.DirentList(f)))
+                 for (r, d, f) in _local_walk(root, warning, _cached_list_dir, prune=prune) )
+    for path in cache.keys():
+        if path not in scan:
+            del cache[path]
+    return scan
 
-# db is dict mapping canonical relative pathname -> (mtime, size) tuples
 
-def _get_db(device, remote_folder):
-    outf = StringIO()
+def _load_pickle(filename):
+    """Return what's pickled in *filename*, or None if it's missing or unreadable."""
     try:
-        with device.sync_transaction() as sock:
-            device.sync_pull(sock, posixjoin(remote_folder, _DB_NAME), outf)
-            db = pickle.loads(outf.getvalue())
-            # XXX bugfix
-            #if '/' in db: db[''] = db.pop('/')
-            return db
-    except adb.AdbError:
-        return {}
+        with open(filename, 'rb') as f:
+            return cPickle.load(f)
+    except Exception:
+        return None
+
+def _save_pickle(filename, obj, warning):
+    """Pickle *obj* into *filename*, replacing it all at once."""
+    tmp_file = filename + '.tmp'
+    try:
+        with open(tmp_file, 'wb') as f:
+            cPickle.dump(obj, f, -1)
+        try: os.unlink(filename)
+        except OSError: pass
+        os.rename(tmp_file, filename)
+    except (IOError, OSError) as e:
+        warning("Could not save %s: %s" % (filename, e))
+
+
+def _cached_local_scan(root, warning, cache_file, rescan=False, prune=None):
+    """_local_scan, with the cache kept in *cache_file* between runs.
+    If *rescan*, start from an empty cache."""
+    cache = {}
+    saved = None if rescan else _load_pickle(cache_file)
+    if saved is not None and saved[0] == os.path.abspath(root):
+        # Stored as plain tuples; namedtuples pickle very slowly
+        make = adb.dirent._make
+        for (path, (mtime, dirs, files)) in saved[1].iteritems():
+            cache[path] = (mtime, map(make, dirs), adb.DirentList(files))
+    before = dict( (path, hit[0]) for (path, hit) in cache.iteritems() )
+
+    scan = _local_scan(root, warning, cache, prune)
+
+    # Untrusted entries get listed every time, so only trusted ones matter here
+    if before != dict( (path, hit[0]) for (path, hit) in cache.iteritems() ):
+        saved = dict( (path, (mtime, map(tuple, dirs), map(tuple, files)))
+                      for (path, (mtime, dirs, files)) in cache.iteritems() )
+        _save_pickle(cache_file, (os.path.abspath(root), saved), warning)
+    return scan
+
+
+def _cached_hashes(files, cache, hash_all):
+    """*files* is a list of (key, path, dirent).  Return a dict mapping path -> md5
+    hex digest, and whether *cache* changed.
+
+    *cache* maps key -> (size, mtime, digest), and is used for files whose size
+    and mtime still match.  The rest are hashed by *hash_all(paths)*, which
+    returns a dict like ours, leaving out what it couldn't hash."""
+    hashes = {}
+    misses = []
+    for (key, path, de) in files:
+        hit = cache.get(key)
+        if hit is not None and hit[0] == de.size and hit[1] == de.mtime:
+            hashes[path] = hit[2]
+        else:
+            misses.append( (key, path, de) )
+    if not misses:
+        return hashes, False
+    fresh = hash_all([path for (key, path, de) in misses])
+    for (key, path, de) in misses:
+        digest = fresh.get(path)
+        if digest is not None:
+            hashes[path] = digest
+            cache[key] = (de.size, de.mtime, digest)
+    return hashes, True
+
+
+def _md5_files(paths, warning):
+    """Return a dict mapping each of *paths* -> md5 hex digest.
+    Files that can't be read are left out."""
+    hashes = {}
+    for path in paths:
+        h = hashlib.md5()
+        try:
+            with open(path, 'rb') as inf:
+                for block in iter(lambda: inf.read(1024*1024), ''):
+                    h.update(block)
+        except IOError:
+            warning("Unreadable: %s" % path)
+            continue
+        hashes[path] = h.hexdigest()
+    return hashes
+
+
+def _scan_walk(scan, root, prune=None):
+    """Like _local_walk, but replays a _local_scan instead of touching the disk.
+    As with os.walk, the caller may prune or reorder *dirs* in place."""
+    dirs, files = scan.get(root, ([], []))
+    if prune is not None:
+        dirs, files = prune(root, dirs, files)
+    dirs = list(dirs)
+    yield root, dirs, files
+    for subdir in dirs:
+        for tup in _scan_walk(scan, posixjoin(root, subdir.name), prune):
+            yield tup
+
+
+def _pruner(filters, top):
+    """Return a prune(path, dirs, files) -> (dirs, files) for _local_walk and
+    friends, which drops what *filters* exclude from directories under *top*.
+    *filters* is a Filter, or a list of rules for one.  None if it's None."""
+    if filters is None:
+        return None
+    if not isinstance(filters, Filter):
+        filters = Filter(filters)
+    def prune(path, dirs, files):
+        return filters.prune(path[len(top)+1:], dirs, files)
+    return prune
+
 
+def _find_prunes(filters):
+    """What device.walk can leave out for *filters*; see Filter.find_prunes()."""
+    if filters is None:
+        return ()
+    if not isinstance(filters, Filter):
+        filters = Filter(filters)
+    return filters.find_prunes()
+
+
+# ----------------------------------------------------------------------
+# db stuff
+# ----------------------------------------------------------------------
 
-def _put_db(device, sock, remote_folder, dct):
-    inf = StringIO(pickle.dumps(dct, -1))
-    device.sync_push(sock, inf, posixjoin(remote_folder, _DB_NAME))
+# db is dict mapping canonical relative pathname -> (mtime, size) tuples.
+# See android.filedb for how it's kept on the device.
 
-        
 def _db_walk(db, root):
     """Exactly same api as device.walk.  This one doesn't bother communicating
     with the device; it assumes that the db is complete and valid"""
     # Convert flat list of files to a tree structure
 
     class _Directory(object):
+        __slots__ = ('path', 'child_files', 'child_dirs')
         def __init__(self, path):
             self.path = path    # relative to root of db
             self.child_files = []
@@ -198,35 +507,306 @@ def _db_walk(db, root):
     return _walk(dir_map[''])
     
 
+# ----------------------------------------------------------------------
+# Parallel transfers
+# ----------------------------------------------------------------------
+
+class _Jobs(object):
+    """One worker's iterator over a _TransferQueue.  Blocks for the next job
+    until the queue is closed."""
+    def __init__(self, xfer):
+        self.xfer = xfer
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        xfer = self.xfer
+        while not xfer.stop.is_set():
+            try: entry = xfer.todo.get(True, 1.0)
+            except Queue.Empty: continue
+            if entry[2] is None:
+                xfer.todo.put(entry)    # leave the end marker for the other workers
+                break
+            return entry[2]
+        raise StopIteration
+
+    def ready(self):
+        """Yield only the jobs that are already queued, without waiting."""
+        xfer = self.xfer
+        while not xfer.stop.is_set():
+            try: entry = xfer.todo.get_nowait()
+            except Queue.Empty: return
+            if entry[2] is None:
+                xfer.todo.put(entry)
+                return
+            yield entry[2]
+
+
+_LAST = (float('inf'),)         # ranks after any job
+
+class _TransferQueue(object):
+    """Runs jobs over up to *streams* concurrent sync transactions, while more
+    jobs are still being put().  Each worker calls *transfer(sock, jobs)* with
+    its own sync socket and a _Jobs iterator; *transfer* yields each job when
+    it is finished (for example, AdbDevice.sync_push_many).
+
+    Workers are started as jobs arrive, and only talk to the device; finished
+    jobs come back through finished() and join(), in the caller's thread, so
+    the caller can update its own state without locking.
+
+    Queued jobs are handed out lowest *rank(job)* first (a tuple), and in the
+    order they were put otherwise."""
+    def __init__(self, device, streams, transfer, rank=None):
+        self.device = device
+        self.transfer = transfer
+        self.rank = rank
+        self.todo = Queue.PriorityQueue()   # (rank, seq, job), then (_LAST, seq, None) once closed
+        self.seq = 0
+        self.done = Queue.Queue()       # (job, None), or (None, exc_info) when a worker exits
+        self.stop = threading.Event()
+        self.error = None
+        self.running = 0
+        self.started = 0
+        self.max_workers = max(1, streams)
+        if device.pool.max_streams:
+            # Leave a connection for the caller, who may be holding one already
+            self.max_workers = min(self.max_workers, max(1, device.pool.max_streams - 1))
+
+    def _worker(self):
+        try:
+            with self.device.sync_transaction() as sock:
+                for job in self.transfer(sock, _Jobs(self)):
+                    self.done.put((job, None))
+        except Exception:
+            self.done.put((None, sys.exc_info()))
+        else:
+            self.done.put((None, None))
+
+    def put(self, job):
+        self.seq += 1
+        self.todo.put( (self.rank(job) if self.rank else (), self.seq, job) )
+        if self.started < self.max_workers and not self.stop.is_set():
+            self.started += 1
+            self.running += 1
+            w = threading.Thread(target=self._worker)
+            w.daemon = True
+            w.start()
+
+    def close(self):
+        """No more jobs are coming."""
+        self.seq += 1
+        self.todo.put( (_LAST, self.seq, None) )
+
+    def abort(self):
+        """Stop handing out jobs.  Workers finish what's in flight and exit."""
+        self.stop.set()
+
+    def _drain(self, block):
+        while self.running:
+            # Poll, so that KeyboardInterrupt still gets through
+            try: job, exc_info = self.done.get(block, 1.0)
+            except Queue.Empty:
+                if block: continue
+                return
+            if job is not None:
+                yield job
+                continue
+            self.running -= 1
+            if exc_info is not None and self.error is None:
+                # Let the other workers finish what's in flight, then report it
+                self.error = exc_info
+                self.stop.set()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+
+    def finished(self):
+        """Yield the jobs finished so far, without waiting."""
+        return self._drain(False)
+
+    def join(self):
+        """Close the queue, and yield the remaining jobs as they finish."""
+        self.close()
+        try:
+            for job in self._drain(True):
+                yield job
+        finally:
+            self.stop.set()
+
+
+def _ordered(items, order, size):
+    """Return *items* in the order to transfer them, for rsync()'s *order*.
+    *size(item)* is the size of each one."""
+    if order is None:
+        return items
+    items = sorted(items, key=size)
+    if order == 'size':
+        return items
+    # 'interleave': smallest, largest, next smallest, next largest, ...
+    out = []
+    lo, hi = 0, len(items)-1
+    while lo <= hi:
+        out.append(items[lo])
+        if lo != hi:
+            out.append(items[hi])
+        lo, hi = lo+1, hi-1
+    return out
+
+
+def _parallel_sync(device, jobs, streams, transfer):
+    """Run all of *jobs* through a _TransferQueue, and yield them back as they finish.
+    Only QUEUE_AHEAD per stream are queued at once, so *jobs* may be a generator
+    over a huge list without it all being built."""
+    xfer = _TransferQueue(device, streams, transfer)
+    finished = xfer._drain(True)
+    pending = 0
+    try:
+        for job in jobs:
+            xfer.put(job)
+            pending += 1
+            if pending >= QUEUE_AHEAD * xfer.max_workers:
+                yield finished.next()
+                pending -= 1
+        xfer.close()
+        for job in finished:
+            yield job
+    finally:
+        xfer.stop.set()
+
+
+class _FileList(object):
+    """A list of (l_root, l_dirent, r_root) tuples, as rsync() collects them,
+    kept small for big trees.  Each (l_root, r_root) pair is stored once, and
+    each file as the index of its pair and a row of a DirentList.  Tuples are
+    made as they're read."""
+    __slots__ = ('roots', 'index', 'which', 'dirents')
+
+    def __init__(self, items=()):
+        self.roots = []         # (l_root, r_root)
+        self.index = {}         # (l_root, r_root) -> its index in roots
+        self.which = array('L')
+        self.dirents = adb.DirentList()
+        for tup in items:
+            self.append(tup)
+
+    def append(self, tup):
+        (l_root, l_dirent, r_root) = tup
+        roots = self.roots
+        # Files come a directory at a time, so this is nearly always the last pair
+        if roots and roots[-1][0] is l_root and roots[-1][1] is r_root:
+            i = len(roots) - 1
+        else:
+            i = self.index.get( (l_root, r_root) )
+            if i is None:
+                i = self.index[ (l_root, r_root) ] = len(roots)
+                roots.append( (l_root, r_root) )
+        self.which.append(i)
+        self.dirents.append(l_dirent)
+
+    def __len__(self):
+        return len(self.dirents)
+
+    def __getitem__(self, i):
+        (l_root, r_root) = self.roots[self.which[i]]
+        return (l_root, self.dirents[i], r_root)
+
+    def __iter__(self):
+        roots = self.roots
+        for (i, l_dirent) in izip(self.which, self.dirents):
+            (l_root, r_root) = roots[i]
+            yield (l_root, l_dirent, r_root)
+
+
 # ----------------------------------------------------------------------
 # rsync
 # ----------------------------------------------------------------------
 
-def rsync(device, local_folder, remote_folder, #report,
+def rsync(device, local_folder, remote_folder,
           warning=None,
           fast=False,
-          trial_run=False):
+          trial_run=False,
+          streams=1,
+          local_scan=None,
+          scan_cache=None,
+          rescan=False,
+          checksum=False,
+          hash_cache=None,
+          delta_min_size=None,
+          resume_min_size=None,
+          bundle_max_file=None,
+          bundle_size=adb.BUNDLE_SIZE,
+          streaming=False,
+          order=None,
+          priority=None,
+          priority_done=None,
+          filters=None,
+          report=None):
     """Make *remote_folder* match *local_folder*.
 
     If *warning*, call that function for all warnings.
     If *fast*, query db instead of remote filesystem.  See discussion in header.
     If *trial_run*, do not do any copying or removing.
+    *streams* is the number of sync connections to push files over at once.
+    *local_scan* is a _local_scan() of *local_folder* to use instead of walking it again.
+    *scan_cache* is a file to keep a manifest of *local_folder* in between runs.
+    Directories whose mtime hasn't changed are taken from it instead of being
+    rescanned.  See discussion in header.  If *rescan*, scan everything anyway.
+    If *checksum*, files of the same size are compared by content (md5) rather
+    than by mtime, and only pushed if the contents differ.  *hash_cache* is a
+    file to keep local and remote hashes in between runs, so files whose size
+    and mtime haven't changed aren't read again on either side.
+    Changed files of at least *delta_min_size* bytes are patched in place
+    block by block (see AdbDevice.sync_patch) rather than pushed whole.
+    Other new or changed files of at least *resume_min_size* bytes are pushed
+    with AdbDevice.sync_push_resumable, so an interrupted run doesn't start
+    them over.
+    New or changed files of at most *bundle_max_file* bytes are pushed in tar
+    bundles of up to *bundle_size* bytes and unpacked on the device.
+    If *streaming*, start transferring while the comparison is still running.
+    See discussion in header.
+    *order* is the order to transfer files in: None for the order they were
+    found, 'size' for smallest first, or 'interleave' to alternate small and
+    large ones.  In streaming mode only files already found can be reordered,
+    and 'interleave' is the order they were found.
+    *priority* is a list of glob patterns, matched against paths relative to
+    *local_folder* (lowercase, with /).  Matching files go before all others,
+    and once every one of them that needed copying is on the device and in
+    the db, *priority_done* (if given) is called.
+    *filters* is a list of include/exclude rules (see android.filters), or a
+    Filter.  Excluded files are neither copied nor removed from the device,
+    and excluded directories aren't walked on either side.
+    If *report*, call that function instead of progress() for status lines.
     """
 
     pathExists = os.path.exists(local_folder)
     if not pathExists:
         print("path does not exist: " + local_folder)
     assert pathExists
+    assert order in ORDERS, order
+    if report is None:
+        report = progress
     if warning is None:
         def warning(w): print w
+    if priority is not None:
+        priority = [pat.lower() for pat in priority]
 
-    db = _get_db(device, remote_folder)
-    db_mtimes = dict( (name, mtime) for (name, (mtime,size)) in db.iteritems() )
+    filedb = FileDb(device, remote_folder)
+    with trace.phase('db fetch'):
+        db = filedb.load()
     can_use_mtime = device.does_mtime_work()
     
-    l_walk = _local_walk(local_folder, warning)
+    l_prune = _pruner(filters, local_folder)
+    r_prune = _pruner(filters, remote_folder)
+    if local_scan is None and scan_cache is not None:
+        with trace.phase('local scan'):
+            local_scan = _cached_local_scan(local_folder, warning, scan_cache, rescan, l_prune)
+    if local_scan is not None: l_walk = _scan_walk(local_scan, local_folder, l_prune)
+    else:                      l_walk = _local_walk(local_folder, warning, prune=l_prune)
     if fast: r_walk = _db_walk(db, remote_folder)
-    else:    r_walk = device.walk(remote_folder)
+    else:    r_walk = device.walk(remote_folder, _find_prunes(filters))
+    l_walk = trace.timed('local walk', l_walk)
+    r_walk = trace.timed('remote walk', r_walk)
 
     def _to_dct_and_set(dirents):
         d = dict( (de.name.lower(), de) for de in dirents )
@@ -240,130 +820,681 @@ def rsync(device, local_folder, remote_folder, #report,
         if abs(l_dirent.mtime-r_mtime) > 5: return True
         return False
 
-    to_add = []
+    def _changed(l_root, l_dirent, r_root, r_dirent):
+        # The db on the device still vouches for the old file, so in streaming
+        # mode this waits until the first checkpoint
+        if delta_min_size is not None and l_dirent.size >= delta_min_size and r_dirent.size:
+            _add(to_patch, (l_root, l_dirent, r_root), True)
+        else:
+            _add(to_add, (l_root, l_dirent, r_root), True)
+
+    def _add(lst, tup, defer):
+        lst.append(tup)
+        if priority is not None:
+            db_key = _job(*tup)[3]
+            if any(fnmatch.fnmatchcase(db_key, pat) for pat in priority):
+                prio_pending.add(db_key)
+        if xfer is not None:
+            if defer: deferred.append( (lst, tup) )
+            else:     _queue(lst, tup)
+
+    def _job(l_root, l_dirent, r_root):
+        l_full = "%s/%s" % (l_root, l_dirent.name)
+        r_full = "%s/%s" % (r_root, l_dirent.name)
+        db_key = r_full[len(remote_folder)+1:].lower()
+        return (l_full, r_full, l_dirent, db_key)
+
+    def _jobs(lst):
+        for tup in lst:
+            yield _job(*tup)
+
+    def _is_priority(tup):
+        return bool(prio_pending) and _job(*tup)[3] in prio_pending
+
+    def _stream_rank(item):
+        # Streaming mode's queue order; see _TransferQueue
+        (kind, job) = item
+        jobs = job if kind == 'bundle' else [job]
+        rank = 0 if any(j[3] in prio_pending for j in jobs) else 1
+        if order == 'size':
+            return (rank, sum(j[2].size for j in jobs))
+        return (rank,)
+
+    def _priority_landed():
+        # True, once, when the last priority file has been recorded
+        if priority is None or prio_pending or prio_signalled:
+            return False
+        prio_signalled.append(True)
+        return True
+
+    def _resumable(job):
+        return resume_min_size is not None and job[2].size >= resume_min_size
+
+    def _push_resumable_all(sock, jobs):
+        for job in jobs:
+            t_start = time.time()
+            device.sync_push_resumable(sock, job[0], job[1])
+            trace.sample('push', t_start, job[1])
+            yield job
+
+    def _patch_all(sock, jobs):
+        for job in jobs:
+            t_start = time.time()
+            device.sync_patch(sock, job[0], job[1])
+            trace.sample('patch', t_start, job[1])
+            yield job
+
+    def _bundles(lst):
+        bundle, nb = [], 0
+        for job in _jobs(lst):
+            if bundle and nb + job[2].size > bundle_size:
+                yield bundle
+                bundle, nb = [], 0
+            bundle.append(job)
+            nb += job[2].size + 512         # plus a tar header
+        if bundle:
+            yield bundle
+
+    def _bundle_all(sock, bundles):
+        for bundle in bundles:
+            t_start = time.time()
+            if device.sync_push_bundle(sock, bundle, remote_folder):
+                trace.sample('bundle', t_start, "%d files" % len(bundle))
+                for job in bundle:
+                    yield job
+            else:
+                for job in device.sync_push_many(sock, bundle):
+                    yield job
+
+    def _stream_all(sock, jobs):
+        # Streaming mode's transfer: jobs are ('push'|'resume'|'patch'|'bundle', job).
+        # Runs of pushes that are already queued are pipelined together.
+        held = []
+        def _pushes(first):
+            yield first
+            for (kind, job) in jobs.ready():
+                if kind != 'push':
+                    held.append( (kind, job) )
+                    return
+                yield job
+        while True:
+            if held: (kind, job) = held.pop()
+            else:
+                try: (kind, job) = jobs.next()
+                except StopIteration: return
+            if kind == 'push':   done = device.sync_push_many(sock, _pushes(job))
+            elif kind == 'resume': done = _push_resumable_all(sock, [job])
+            elif kind == 'patch': done = _patch_all(sock, [job])
+            else:                done = _bundle_all(sock, [job])
+            for job in done:
+                yield job
+
+    def _queue(lst, tup):
+        # Streaming mode: hand one file to the transfer queue
+        job = _job(*tup)
+        estimator.v1 += job[2].size
+        estimator.n1 += 1
+        if lst is to_patch:
+            xfer.put( ('patch', job) )
+        elif _resumable(job):
+            xfer.put( ('resume', job) )
+        elif (bundle_max_file is not None and job[2].size <= bundle_max_file and
+              job[3] not in prio_pending):
+            if bundling and bundling_size[0] + job[2].size > bundle_size:
+                _flush_bundle()
+            bundling.append(job)
+            bundling_size[0] += job[2].size + 512
+        else:
+            xfer.put( ('push', job) )
+
+    def _flush_bundle():
+        if bundling:
+            xfer.put( ('bundle', list(bundling)) )
+            del bundling[:]
+            bundling_size[0] = 0
+
+    def _record(job):
+        # Only record files the device has acknowledged
+        (l_full, r_full, l_dirent, db_key) = job
+        new_db[db_key] = ( l_dirent.mtime, l_dirent.size )
+        unsaved.append(db_key)
+        prio_pending.discard(db_key)
+        pct, eta = estimator.increment(l_dirent.size, 1)
+        report("[%3d%%] [%s] %s/s %s" % (
+                pct, _fmt_sec(eta), _fmt_bytes(estimator.dvdt),
+                os.path.relpath(l_full, local_folder)))
+
+    to_add = _FileList()
+    to_patch = _FileList()      # like to_add, but the remote file exists and is worth patching
     to_remove = []
     to_remove_dir = []
-    new_db = {}                 # easier to create from scratch than to mutate prev db
+    to_hash = _FileList()       # for checksum mode; like to_add...
+    to_hash_r = _FileList()     # ...with the remote dirents alongside
+    new_db = DbDict()           # easier to create from scratch than to mutate prev db
+    unsaved = []                # new_db keys changed since the last checkpoint
+    prio_pending = set()        # db keys of priority files not yet recorded
+    prio_signalled = []         # [True] once priority_done has been called
     first = True
 
-    if fast: progress("Scanning %s" % (local_folder,))
-    else:    progress("Comparing %s to %s" % (local_folder, remote_folder,))
+    xfer = None
+    if streaming and not trial_run:
+        xfer = _TransferQueue(device, streams, _stream_all, _stream_rank)
+        estimator = TimeEstimator(0, item_cost=ETA_FILE_COST)
+        deferred = []           # (to_add or to_patch, tup) to queue after the first checkpoint
+        blocked_dirs = set()    # remote dirs that only exist once a file in the way is removed
+        bundling = []           # small files for the next bundle
+        bundling_size = [0]
+
+    if fast: report("Scanning %s" % (local_folder,))
+    else:    report("Comparing %s to %s" % (local_folder, remote_folder,))
 
-    for ((l_root, l_dirs, l_files), (r_root, r_dirs, r_files)) in izip(l_walk, r_walk):
-        # Verify that the walks are proceeding in lockstep
-        assert first or os.path.basename(l_root).lower() == os.path.basename(r_root).lower(), (
-            l_root, r_root)
-        first = False
+    try:
+        t_compare = time.time()
+        for ((l_root, l_dirs, l_files), (r_root, r_dirs, r_files)) in izip(l_walk, r_walk):
+            # Verify that the walks are proceeding in lockstep
+            assert first or os.path.basename(l_root).lower() == os.path.basename(r_root).lower(), (
+                l_root, r_root)
+            first = False
+            if r_prune is not None:
+                # In place, so the walk doesn't go into excluded dirs
+                r_dirs[:], r_files = r_prune(r_root, r_dirs, r_files)
 
-        # classify files
-        l_files_dct, l_files_set = _to_dct_and_set(l_files)
-        r_files_dct, r_files_set = _to_dct_and_set(r_files)
+            # classify files
+            l_files_dct, l_files_set = _to_dct_and_set(l_files)
+            r_files_dct, r_files_set = _to_dct_and_set(r_files)
+            l_dirs_dct, l_dirs_set = _to_dct_and_set(l_dirs)
+            r_dirs_dct, r_dirs_set = _to_dct_and_set(r_dirs)
+            blocked = xfer is not None and r_root in blocked_dirs
+            # This directory's part of the db, keyed by lowercase name
+            db_dir = r_root[len(remote_folder)+1:].lower()
+            db_here = db.listdir(db_dir)
+            new_here = {}
 
-        for missing in l_files_set - r_files_set:
-            to_add.append( (l_root, l_files_dct[missing], r_root) )
+            for missing in l_files_set - r_files_set:
+                # Streamed files wait for the removals if a dir is in the way,
+                # and for the first checkpoint if the db has an entry for them
+                defer = blocked or missing in r_dirs_set or missing in db_here
+                _add(to_add, (l_root, l_files_dct[missing], r_root), defer)
 
-        for extra in r_files_set - l_files_set:
-            # Special case: don't remove our mtime db!
-            if extra == _DB_NAME and r_root == remote_folder:
-                continue
-            to_remove.append( "%s/%s" % (r_root, r_files_dct[extra].name) )
-
-        for common in r_files_set & l_files_set:
-            # db key is the path relative to the root, in canonical form
-            db_key = ("%s/%s" % (r_root, common))
-            db_key = db_key[len(remote_folder)+1:].lower()
-            assert db_key != '/', (r_root,common,remote_folder)
-            l_dirent = l_files_dct[common]
-            r_dirent = r_files_dct[common]
-            if can_use_mtime:
-                db_mtimes[db_key] = r_dirent.mtime
-            if _different(l_dirent, r_dirent, db_mtimes.get(db_key,0)):
-                to_add.append( (l_root, l_dirent, r_root) )
-            else:
-                try:
-                    new_db[db_key] = db[db_key]
-                except KeyError:
+            for extra in r_files_set - l_files_set:
+                # Special case: don't remove our mtime db!
+                if r_root == remote_folder and is_db_file(extra):
+                    continue
+                # ...or a partial push that the next one can pick up
+                if adb.resume_part_owner(extra) in l_files_set:
+                    continue
+                to_remove.append( "%s/%s" % (r_root, r_files_dct[extra].name) )
+
+            for common in r_files_set & l_files_set:
+                l_dirent = l_files_dct[common]
+                r_dirent = r_files_dct[common]
+                # The device's mtime if it can be trusted, and otherwise the db's
+                db_entry = db_here.get(common)
+                if can_use_mtime:         r_mtime = r_dirent.mtime
+                elif db_entry is not None: r_mtime = db_entry[0]
+                else:                     r_mtime = 0
+                if checksum and l_dirent.size == r_dirent.size:
+                    to_hash.append( (l_root, l_dirent, r_root) )
+                    to_hash_r.append( (l_root, r_dirent, r_root) )
+                elif _different(l_dirent, r_dirent, r_mtime):
+                    _changed(l_root, l_dirent, r_root, r_dirent)
+                elif db_entry is not None:
+                    new_here[common] = db_entry
+                else:
                     # db doesn't contain info about a remote file, but it's identical?  Hmm.
                     tmp = (r_dirent.mtime if can_use_mtime else l_dirent.mtime)
-                    new_db[db_key] = (tmp, r_dirent.size)
-
-        # classify_dirs
-        l_dirs_dct, l_dirs_set = _to_dct_and_set(l_dirs)
-        r_dirs_dct, r_dirs_set = _to_dct_and_set(r_dirs)
-        for missing in l_dirs_set - r_dirs_set:
-            # It so happens that adb doesn't barf if you try to listdir a nonexistent directory.
-            # It just returns nothing.  So, let's pretend the remote dir exists and is empty,
-            # and iterate into it; that way all file-adds are handled the same way
-            r_dirs_set.add(missing)
-            r_dirs_dct[missing] = adb.dirent(None,None,None,l_dirs_dct[missing].name)
-        for extra in r_dirs_set - l_dirs_set:
-            to_remove_dir.append( "%s/%s" % (r_root, r_dirs_dct[extra].name) )
-        # Mutate the directory lists in-place to control the iteration's future
-        del l_dirs[:], r_dirs[:]
-        for common in r_dirs_set & l_dirs_set:
-            l_dirs.append(l_dirs_dct[common])
-            r_dirs.append(r_dirs_dct[common])
+                    new_here[common] = (tmp, r_dirent.size)
+            new_db.update_dir(db_dir, new_here)
 
-    if trial_run:
-        # Just report on what we would do.
-        if to_remove_dir:
-            progress("Would remove %s" % _plural(to_remove_dir, 'dir'), 1)
-        if to_remove:
-            progress("Would remove %s" % _plural(to_remove, 'file'), 1)
-        if to_add:
-            nb = sum(tup[1].size for tup in to_add)
-            progress("Would copy %s in %s" % (_fmt_bytes(nb), _plural(to_add, 'file')), 1)
-        return
-        
-    # Perform operations and finish creating new_db
-    with device.sync_transaction() as sock:
-        _put_db(device, sock, remote_folder, new_db)     # checkpoint it
-        n = 0 ; total = len(to_remove_dir) + len(to_remove) + len(to_add)
-        # Process removals before adds, because dirs might be in the way of files
-        for r_full in to_remove_dir:
-            n += 1 ; pct = n*100//total
-            progress("[%3d%%] Rmdir %s/" % (pct, os.path.relpath(r_full, remote_folder)))
-            if not r_full.startswith('/sdcard/dfp'):
+            # classify_dirs
+            for missing in l_dirs_set - r_dirs_set:
+                # It so happens that adb doesn't barf if you try to listdir a nonexistent directory.
+                # It just returns nothing.  So, let's pretend the remote dir exists and is empty,
+                # and iterate into it; that way all file-adds are handled the same way
+                r_dirs_set.add(missing)
+                r_dirs_dct[missing] = adb.dirent(None,None,None,l_dirs_dct[missing].name)
+                if xfer is not None and missing in r_files_set:
+                    blocked_dirs.add( "%s/%s" % (r_root, l_dirs_dct[missing].name) )
+            for extra in r_dirs_set - l_dirs_set:
+                to_remove_dir.append( "%s/%s" % (r_root, r_dirs_dct[extra].name) )
+            # Mutate the directory lists in-place to control the iteration's future.
+            # Keep the local order, which is the order _local_walk reads ahead in.
+            l_order = dict( (de.name.lower(), i) for (i, de) in enumerate(l_dirs) )
+            del l_dirs[:], r_dirs[:]
+            for common in sorted(r_dirs_set & l_dirs_set, key=l_order.get):
+                l_dirs.append(l_dirs_dct[common])
+                r_dirs.append(r_dirs_dct[common])
+                if blocked:
+                    blocked_dirs.add( "%s/%s" % (r_root, r_dirs_dct[common].name) )
+
+            if xfer is not None:
+                for job in xfer.finished():
+                    _record(job)
+        # The walks are in lockstep, so this is just the remote walk noticing it's
+        # done too, and giving its connection (if it used one) back to the pool
+        for _ in r_walk:
+            pass
+        trace.span('compare', t_compare)
+
+        if to_hash:
+            t_hash = time.time()
+            report("Checksumming %s" % _plural(to_hash, 'file'), 1)
+            # Local files are keyed by path, and remote ones by (serial, path)
+            cache = {}
+            if hash_cache is not None:
+                cache = _load_pickle(hash_cache) or {}
+            l_files, r_files = [], []
+            for ((l_root, l_dirent, r_root), (_, r_dirent, _)) in izip(to_hash, to_hash_r):
+                l_full = "%s/%s" % (l_root, l_dirent.name)
+                r_full = "%s/%s" % (r_root, r_dirent.name)
+                l_files.append( (l_full, l_full, l_dirent) )
+                r_files.append( ((device.serial, r_full), r_full, r_dirent) )
+            l_hashes, l_dirty = _cached_hashes(l_files, cache, lambda paths: _md5_files(paths, warning))
+            r_hashes, r_dirty = _cached_hashes(r_files, cache, device.file_hashes)
+            del l_files, r_files
+            if hash_cache is not None and (l_dirty or r_dirty):
+                _save_pickle(hash_cache, cache, warning)
+            for ((l_root, l_dirent, r_root), (_, r_dirent, _)) in izip(to_hash, to_hash_r):
+                l_hash = l_hashes.get("%s/%s" % (l_root, l_dirent.name))
+                r_full = "%s/%s" % (r_root, r_dirent.name)
+                if l_hash is None or l_hash != r_hashes.get(r_full):
+                    _changed(l_root, l_dirent, r_root, r_dirent)
+                else:
+                    # Same contents; record the local mtime so a later run without
+                    # checksums agrees, even where device mtimes can't be trusted
+                    new_db[r_full[len(remote_folder)+1:].lower()] = (l_dirent.mtime, l_dirent.size)
+            trace.span('checksums', t_hash)
+
+        if trial_run:
+            # Just report on what we would do.
+            if to_remove_dir:
+                report("Would remove %s" % _plural(to_remove_dir, 'dir'), 1)
+            if to_remove:
+                report("Would remove %s" % _plural(to_remove, 'file'), 1)
+            if to_add:
+                nb = sum(tup[1].size for tup in to_add)
+                report("Would copy %s in %s" % (_fmt_bytes(nb), _plural(to_add, 'file')), 1)
+            if to_patch:
+                nb = sum(tup[1].size for tup in to_patch)
+                report("Would patch %s in %s" % (_fmt_bytes(nb), _plural(to_patch, 'file')), 1)
+            return
+
+        # Perform operations and finish creating new_db
+        with device.sync_transaction() as sock:
+            if xfer is not None:
+                for job in xfer.finished():
+                    _record(job)
+            filedb.checkpoint(sock, new_db)     # checkpoint it
+            unsaved = []
+            if _priority_landed() and priority_done is not None:
+                priority_done()
+            # Process removals before adds, because dirs might be in the way of files
+            t_remove = time.time()
+            for r_full in to_remove_dir:
+                if not r_full.startswith('/sdcard/dfp'):
+                    warning("Trying to rmdir %s: do it by hand instead." % r_full)
+            to_remove_dir = [r_full for r_full in to_remove_dir if r_full.startswith('/sdcard/dfp')]
+            if to_remove_dir:
+                report("Removing %s" % _plural(to_remove_dir, 'dir'), 1)
+                for r_full in device.remove(to_remove_dir, recursive=True):
+                    warning("Could not rmdir %s" % r_full)
+
+            if to_remove:
+                report("Removing %s" % _plural(to_remove, 'file'), 1)
+                for r_full in device.remove(to_remove):
+                    warning("Could not remove %s" % r_full)
+            trace.span('removals', t_remove)
+
+            AUTOSAVE_INTERVAL = 10
+            t_savedb = time.time() + AUTOSAVE_INTERVAL
+            if xfer is None:
+                estimator = TimeEstimator(sum(tup[1].size for tup in chain(to_add, to_patch)),
+                                          count=len(to_add) + len(to_patch),
+                                          item_cost=ETA_FILE_COST)
+            if len(to_add):
+                report("Copying %s in %s" % (_fmt_bytes(sum(tup[1].size for tup in to_add)),
+                                             _plural(to_add, 'file')), 1)
+
+            def _transfer_group(adds, patches):
+                size = lambda tup: tup[1].size
+                adds = _ordered(adds, order, size)
+                patches = _ordered(patches, order, size)
+                to_bundle = []
+                to_push = adds
+                if bundle_max_file is not None:
+                    to_bundle = _FileList(tup for tup in adds if tup[1].size <= bundle_max_file)
+                    to_push = _FileList(tup for tup in adds if tup[1].size > bundle_max_file)
+                if to_bundle:
+                    with trace.phase('bundles'):
+                        for job in _parallel_sync(device, _bundles(to_bundle), streams, _bundle_all):
+                            yield job
+                with trace.phase('pushes'):
+                    for job in _parallel_sync(device, (job for job in _jobs(to_push) if not _resumable(job)),
+                                              streams, device.sync_push_many):
+                        yield job
+                    for job in _parallel_sync(device, (job for job in _jobs(to_push) if _resumable(job)),
+                                              streams, _push_resumable_all):
+                        yield job
+                if patches:
+                    report("Patching %s" % _plural(patches, 'file'), 1)
+                    with trace.phase('patches'):
+                        for job in _parallel_sync(device, _jobs(patches), streams, _patch_all):
+                            yield job
+
+            def _transfers():
+                # Priority files go through the whole pipeline before anything else
+                groups = [ (to_add, to_patch) ]
+                if prio_pending:
+                    groups = [ (_FileList(tup for tup in to_add if _is_priority(tup)),
+                                _FileList(tup for tup in to_patch if _is_priority(tup))),
+                               (_FileList(tup for tup in to_add if not _is_priority(tup)),
+                                _FileList(tup for tup in to_patch if not _is_priority(tup))) ]
+                for (adds, patches) in groups:
+                    for job in _transfer_group(adds, patches):
+                        yield job
+
+            def _streamed():
+                for (lst, tup) in deferred:
+                    _queue(lst, tup)
+                _flush_bundle()
+                for job in trace.timed('transfers', xfer.join()):
+                    yield job
+
+            for job in (_transfers() if xfer is None else _streamed()):
+                _record(job)
+
+                # Save the db every few seconds, and as soon as the priority
+                # files are in.  The pushes have sockets of their own.
+                t = time.time()
+                landed = _priority_landed()
+                if t > t_savedb or landed:
+                    t_savedb = t + AUTOSAVE_INTERVAL
+                    filedb.checkpoint(sock, new_db, unsaved)
+                    unsaved = []
+                if landed and priority_done is not None:
+                    priority_done()
+
+            filedb.checkpoint(sock, new_db, unsaved)
+    finally:
+        if xfer is not None:
+            xfer.abort()
+        # If the comparison was cut short, stop the walks' threads and connections now
+        for walk in (l_walk, r_walk):
+            if hasattr(walk, 'close'):
+                walk.close()
+
+def rsync_many(devices, local_folder, remote_folder,
+               warning=None,
+               scan_cache=None,
+               rescan=False,
+               filters=None,
+               **kwargs):
+    """Make *remote_folder* match *local_folder* on every device in *devices* at once.
+
+    *local_folder* is scanned once and the result shared; each device then gets
+    its own rsync() in its own thread, with status lines and warnings prefixed by
+    its serial.  *scan_cache*, *rescan* and *filters* are as for rsync(), and other
+    keyword arguments are passed through to it.
+
+    A failure on one device doesn't stop the others.  Returns a dict mapping
+    each device's serial to None on success, or to the exception it raised.
+    """
+    if warning is None:
+        def warning(w): print w
+
+    progress("Scanning %s" % (local_folder,))
+    with trace.phase('local scan'):
+        prune = _pruner(filters, local_folder)
+        if scan_cache is not None: scan = _cached_local_scan(local_folder, warning, scan_cache, rescan, prune)
+        else:                      scan = _local_scan(local_folder, warning, prune=prune)
+    results = {}
+
+    def _run(device):
+        def _report(txt, bNewline=False):
+            progress("[%s] %s" % (device.serial, txt), bNewline)
+        def _warning(w):
+            warning("[%s] %s" % (device.serial, w))
+        try:
+            rsync(device, local_folder, remote_folder,
+                  report=_report, warning=_warning, local_scan=scan, filters=filters, **kwargs)
+        except Exception as e:
+            _warning("rsync failed: %s" % (e,))
+            results[device.serial] = e
+        else:
+            results[device.serial] = None
+
+    threads = [threading.Thread(target=_run, args=(device,)) for device in devices]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        # Poll, so that KeyboardInterrupt still gets through
+        while t.is_alive():
+            t.join(1.0)
+    return results
+
+
+def rsync_watch(device, local_folder, remote_folder,
+                report=None,
+                warning=None,
+                debounce=WATCH_DEBOUNCE,
+                stop=None,
+                filters=None,
+                **kwargs):
+    """Keep *remote_folder* matching *local_folder* as *local_folder* changes.
+
+    Starts with a normal rsync(), then watches *local_folder* (see
+    android.watch).  Once *debounce* seconds go by without more changes, the
+    files that changed are pushed, and the ones that went away are removed,
+    over one long-lived sync connection, and the db is checkpointed after
+    each batch.  Runs until *stop* (a threading.Event) is set.
+
+    Anything unexpected -- a push that fails, the watcher losing track --
+    gets a full rsync() again.  *report*, *warning* and *filters* are as for
+    rsync(), and other keyword arguments are passed through to it.
+    """
+    if report is None:
+        report = progress
+    if warning is None:
+        def warning(w): print w
+    if stop is None:
+        stop = threading.Event()
+    local_folder = local_folder.replace(os.sep, '/').rstrip('/')
+    if filters is not None and not isinstance(filters, Filter):
+        filters = Filter(filters)
+    prune = _pruner(filters, local_folder)
+
+    def _scan():
+        # For watch.PollWatcher
+        files = {}
+        for (root, (dirs, l_files)) in _local_scan(local_folder, warning, prune=prune).iteritems():
+            for de in l_files:
+                files[posixjoin(root, de.name)] = (de.size, de.mtime)
+        return files
+
+    def _rel(path):
+        return path[len(local_folder)+1:]
+
+    def _changes(paths, db):
+        # Return (files to push, files to remove, dirs to remove), for the
+        # db keys *paths* might have changed
+        pushes, removes, rmdirs = [], [], []
+        gone = []               # dir keys being removed; sorting puts them before what's in them
+        for path in sorted(paths):
+            rel = _rel(path)
+            key = rel.lower()
+            if any(key.startswith(d + '/') for d in gone):
+                continue
+            try: st = os.stat(path)
+            except OSError: st = None
+            if filters is not None:
+                is_dir = (key not in db) if st is None else stat.S_ISDIR(st.st_mode)
+                if filters.excludes(rel, is_dir):
+                    continue
+            if st is None:
+                # Gone.  A file, or a whole directory of them.
+                if key in db:
+                    removes.append( (posixjoin(remote_folder, rel), key) )
+                prefix = key + '/'
+                under = [k for k in db if k.startswith(prefix)]
+                if under:
+                    rmdirs.append( (posixjoin(remote_folder, rel), under) )
+                    gone.append(key)
+            elif stat.S_ISDIR(st.st_mode):
+                # New (or moved here); it may have arrived full
+                for (root, dirs, files) in _local_walk(path, warning, prune=prune):
+                    for de in files:
+                        rel = _rel(posixjoin(root, de.name))
+                        if db.get(rel.lower()) != (de.mtime, de.size):
+                            pushes.append( (posixjoin(root, de.name), posixjoin(remote_folder, rel),
+                                            de, rel.lower()) )
+            elif stat.S_ISREG(st.st_mode):
+                if db.get(key) != (st.st_mtime, st.st_size):
+                    de = adb.dirent(st.st_mode, st.st_size, st.st_mtime, os.path.basename(path))
+                    pushes.append( (path, posixjoin(remote_folder, rel), de, key) )
+        return pushes, removes, rmdirs
+
+    def _apply(sock, filedb, db, paths):
+        pushes, removes, rmdirs = _changes(paths, db)
+        unsaved = []
+        if removes:
+            for r_full in device.remove([r_full for (r_full, key) in removes]):
+                warning("Could not remove %s" % r_full)
+            for (r_full, key) in removes:
+                db.pop(key, None)
+                unsaved.append(key)
+                report("Removed %s" % r_full[len(remote_folder)+1:])
+        for (r_full, keys) in rmdirs:
+            if r_full.startswith('/sdcard/dfp'):
+                failed = device.remove([r_full], recursive=True)
+            else:
+                failed = device.remove(["%s/%s" % (remote_folder, k) for k in keys])
                 warning("Trying to rmdir %s: do it by hand instead." % r_full)
+            for path in failed:
+                warning("Could not remove %s" % path)
+            for key in keys:
+                db.pop(key, None)
+                unsaved.append(key)
+            report("Removed %s" % r_full[len(remote_folder)+1:])
+        if pushes:
+            estimator = TimeEstimator(sum(job[2].size for job in pushes), count=len(pushes),
+                                      item_cost=ETA_FILE_COST)
+            for job in device.sync_push_many(sock, pushes):
+                (l_full, r_full, l_dirent, db_key) = job
+                db[db_key] = (l_dirent.mtime, l_dirent.size)
+                unsaved.append(db_key)
+                pct, eta = estimator.increment(l_dirent.size, 1)
+                report("[%3d%%] [%s] %s/s %s" % (
+                        pct, _fmt_sec(eta), _fmt_bytes(estimator.dvdt), _rel(l_full)))
+        if unsaved:
+            filedb.checkpoint(sock, db, unsaved)
+
+    w = watch.watcher(local_folder, _scan)
+    try:
+        while not stop.is_set():
+            # Changes made from here on are seen by the watcher, so the
+            # rsync can't miss any
+            rsync(device, local_folder, remote_folder,
+                  report=report, warning=warning, filters=filters, **kwargs)
+            filedb = FileDb(device, remote_folder)
+            db = filedb.load()
+            report("Watching %s" % local_folder, 1)
+            try:
+                with device.sync_transaction() as sock:
+                    while not stop.is_set():
+                        changed = w.read(1.0)
+                        if not changed:
+                            continue
+                        while True:
+                            more = w.read(debounce)
+                            if not more: break
+                            changed |= more
+                        if local_folder in changed:
+                            break       # the watcher lost track; start over
+                        t_start = time.time()
+                        _apply(sock, filedb, db, changed)
+                        trace.span('watch batch', t_start)
+            except (adb.AdbError, EnvironmentError) as e:
+                warning("%s; syncing everything again" % (e,))
+    finally:
+        w.close()
+
+
+def rsync_pull(device, remote_folder, local_folder,
+               report=None,
+               warning=None,
+               trial_run=False,
+               streams=4,
+               filters=None):
+    """Copy new or changed files from *remote_folder* into *local_folder*.
+    The reverse of rsync(), for harvesting captures, dumps, saves and so on.
+
+    Files are compared by size and mtime (pulled files get the device's mtime),
+    so pulling the same folder again only fetches what changed since.  Files
+    that exist only locally are left alone.
+
+    If *report*, call that function instead of progress() for status lines.
+    If *warning*, call that function for all warnings.
+    If *trial_run*, do not do any copying.
+    *streams* is the number of sync connections to pull files over at once.
+    *filters* is as for rsync(); excluded files are neither pulled nor looked at.
+    """
+    if report is None:
+        report = progress
+    if warning is None:
+        def warning(w): print w
+    r_prune = _pruner(filters, remote_folder)
+
+    with trace.phase('local scan'):
+        if os.path.isdir(local_folder): scan = _local_scan(local_folder, warning,
+                                                           prune=_pruner(filters, local_folder))
+        else:                           scan = {}
+
+    report("Comparing %s to %s" % (remote_folder, local_folder))
+    to_fetch = []
+    for (r_root, r_dirs, r_files) in trace.timed('remote walk', device.walk(remote_folder, _find_prunes(filters))):
+        if r_prune is not None:
+            r_dirs[:], r_files = r_prune(r_root, r_dirs, r_files)
+        rel = r_root[len(remote_folder)+1:]
+        l_root = posixjoin(local_folder, rel)
+        l_files = dict( (de.name.lower(), de) for de in scan.get(l_root, ([], []))[1] )
+        for r_dirent in r_files:
+            # Don't bring back rsync()'s mtime db
+            if r_root == remote_folder and is_db_file(r_dirent.name):
                 continue
-            device.simple_shell("rm -r '%s'" % r_full)
-
-        for r_full in to_remove:
-            n += 1 ; pct = n*100//total
-            progress("[%3d%%] Remove %s" % (pct, os.path.relpath(r_full, remote_folder)))
-            device.simple_shell("rm '%s'" % r_full)
-
-        AUTOSAVE_INTERVAL = 10
-        estimator = TimeEstimator(sum(tup[1].size for tup in to_add))
-        t_savedb = time.time() + AUTOSAVE_INTERVAL
-        if len(to_add):
-            progress("Copying %s in %s" % (_fmt_bytes(estimator.v1), _plural(to_add, 'file')), 1)
-
-        prev_pct = None
-        for (l_root, l_dirent, r_root) in to_add:
-            l_full = "%s/%s" % (l_root, l_dirent.name)
-            r_full = "%s/%s" % (r_root, l_dirent.name)
-            db_key = r_full[len(remote_folder)+1:].lower()
-
-            new_db[db_key] = ( l_dirent.mtime, l_dirent.size )
-            device.sync_push(sock, l_full, r_full)
-
-            pct, eta = estimator.increment(l_dirent.size)
-            if True or pct != prev_pct:
-                # Cut down on the console traffic a bit
-                prev_pct = pct
-                progress("[%3d%%] [%s] %s/s %s" % (
-                        pct, _fmt_sec(eta), _fmt_bytes(estimator.dvdt),
-                        os.path.relpath(l_full, local_folder)))
-
-            # Save the db every few seconds
-            t = time.time()
-            if t > t_savedb:
-                t_savedb = t + AUTOSAVE_INTERVAL
-                _put_db(device, sock, remote_folder, new_db)
+            # ...or rsync()'s partial pushes
+            if adb.resume_part_owner(r_dirent.name) is not None:
+                continue
+            l_dirent = l_files.get(r_dirent.name.lower())
+            if (l_dirent is None or l_dirent.size != r_dirent.size or
+                abs(l_dirent.mtime - r_dirent.mtime) > 5):
+                to_fetch.append( ("%s/%s" % (r_root, r_dirent.name),
+                                  posixjoin(l_root, r_dirent.name),
+                                  r_dirent) )
+
+    nb = sum(tup[2].size for tup in to_fetch)
+    if trial_run:
+        if to_fetch:
+            report("Would copy %s in %s" % (_fmt_bytes(nb), _plural(to_fetch, 'file')), 1)
+        return
+    if not to_fetch:
+        return
+
+    def _pull_all(sock, jobs):
+        for job in jobs:
+            t_start = time.time()
+            device.sync_pull(sock, job[0], job[1])
+            trace.sample('pull', t_start, job[0])
+            yield job
+
+    estimator = TimeEstimator(nb, count=len(to_fetch), item_cost=ETA_FILE_COST)
+    report("Copying %s in %s" % (_fmt_bytes(nb), _plural(to_fetch, 'file')), 1)
+    for (r_full, l_full, r_dirent) in trace.timed('pulls', _parallel_sync(device, to_fetch, streams, _pull_all)):
+        pct, eta = estimator.increment(r_dirent.size, 1)
+        report("[%3d%%] [%s] %s/s %s" % (
+                pct, _fmt_sec(eta), _fmt_bytes(estimator.dvdt),
+                os.path.relpath(r_full, remote_folder)))
 
-        _put_db(device, sock, remote_folder, new_db)
-            
 
 if __name__ == '__main__':
     pass
@@ -0,0 +1,199 @@
+# -*- python -*-
+#
+# Copyright 2008 - 2015 Double Fine Productions
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#
+# Opt-in instrumentation for adb and rsync.
+#
+#   tracer = trace.start()
+#   rsync.rsync(device, ...)
+#   trace.stop()
+#   tracer.write_json('deploy.json')            # phase totals, counters, histograms
+#   tracer.write_chrome_trace('deploy.trace')   # load in chrome://tracing
+#
+# While no tracer is running, the hooks below cost a global lookup and a test.
+#
+# What gets recorded:
+#   phases      named stretches of time (db fetch, compare, pushes, ...),
+#               which may nest, and may happen on several threads at once
+#   counters    bytes_sent, bytes_recv, frames_sent, frames_recv, round_trips
+#               (times a socket had to wait for a reply to something it sent),
+#               connections, shell_commands
+#   histograms  per-file latencies: push, pull, patch, bundle
+#
+
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+__all__ = ('Tracer', 'start', 'stop', 'phase', 'timed', 'span', 'count', 'sample')
+
+tracer = None           # the running Tracer, if any
+
+
+class Tracer(object):
+    """Collects phases, counters and latency samples.  Safe to share between threads."""
+    def __init__(self):
+        self.t0 = time.time()
+        self.lock = threading.Lock()
+        self.spans = []         # (name, category, thread name, t_start, t_end, args)
+        self.counters = dict.fromkeys(('bytes_sent', 'bytes_recv', 'frames_sent', 'frames_recv',
+                                       'round_trips', 'connections', 'shell_commands'), 0)
+        self.samples = {}       # histogram name -> list of seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def span(self, name, t_start, t_end, category='phase', **args):
+        with self.lock:
+            self.spans.append((name, category, threading.current_thread().name, t_start, t_end, args))
+
+    def sample(self, name, t_start, t_end, label=None):
+        """Record one latency for histogram *name*, and a span for it too."""
+        with self.lock:
+            self.samples.setdefault(name, []).append(t_end - t_start)
+        if label is not None: self.span(name, t_start, t_end, 'file', file=label)
+        else:                 self.span(name, t_start, t_end, 'file')
+
+    # Export
+
+    def summary(self):
+        """Return a dict of phase totals, counters and histograms, suitable for json."""
+        with self.lock:
+            spans = list(self.spans)
+            counters = dict(self.counters)
+            samples = dict( (k, list(v)) for (k, v) in self.samples.iteritems() )
+        phases = {}
+        for (name, category, thread, t_start, t_end, args) in spans:
+            if category != 'phase': continue
+            p = phases.setdefault(name, {'seconds': 0.0, 'count': 0})
+            p['seconds'] += t_end - t_start
+            p['count'] += 1
+        return {
+            'elapsed': time.time() - self.t0,
+            'phases': phases,
+            'counters': counters,
+            'histograms': dict( (k, _histogram(v)) for (k, v) in samples.iteritems() ),
+        }
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+    def write_chrome_trace(self, filename):
+        """Write the spans in the Trace Event format read by chrome://tracing."""
+        with self.lock:
+            spans = list(self.spans)
+        threads = {}
+        events = []
+        for (name, category, thread, t_start, t_end, args) in spans:
+            tid = threads.setdefault(thread, len(threads) + 1)
+            events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': 1, 'tid': tid,
+                           'ts': (t_start - self.t0) * 1e6, 'dur': (t_end - t_start) * 1e6,
+                           'args': args})
+        for (thread, tid) in threads.iteritems():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                           'args': {'name': thread}})
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                       'otherData': self.summary()}, f)
+
+
+def _histogram(values):
+    values = sorted(values)
+    n = len(values)
+    def pct(p): return values[min(n - 1, int(p * n))]
+    # Power-of-two millisecond buckets: "<1ms", "<2ms", "<4ms", ...
+    buckets = {}
+    for v in values:
+        limit = 1
+        while v * 1000 >= limit:
+            limit *= 2
+        key = '<%dms' % limit
+        buckets[key] = buckets.get(key, 0) + 1
+    return {'count': n, 'mean': sum(values) / n, 'min': values[0], 'max': values[-1],
+            'p50': pct(0.5), 'p90': pct(0.9), 'p99': pct(0.99), 'buckets': buckets}
+
+
+def start():
+    """Start recording into a new Tracer, which is returned."""
+    global tracer
+    tracer = Tracer()
+    return tracer
+
+def stop():
+    """Stop recording.  Returns the Tracer that was running, if any."""
+    global tracer
+    t, tracer = tracer, None
+    return t
+
+# ----------------------------------------------------------------------
+# Hooks for the instrumented code
+# ----------------------------------------------------------------------
+
+@contextmanager
+def _phase(t, name):
+    t_start = time.time()
+    try:
+        yield
+    finally:
+        t.span(name, t_start, time.time())
+
+@contextmanager
+def _no_phase():
+    yield
+
+def phase(name):
+    """with phase(name): ... records the time spent in the block."""
+    t = tracer
+    if t is None:
+        return _no_phase()
+    return _phase(t, name)
+
+def timed(name, iterable):
+    """Wrap *iterable* so the time spent producing each item is recorded as phase *name*."""
+    t = tracer
+    if t is None:
+        return iterable
+    return _timed(t, name, iterable)
+
+def _timed(t, name, iterable):
+    it = iter(iterable)
+    while True:
+        t_start = time.time()
+        try:
+            item = it.next()
+        except StopIteration:
+            t.span(name, t_start, time.time())
+            return
+        t.span(name, t_start, time.time())
+        yield item
+
+def span(name, t_start):
+    """Record phase *name*, from *t_start* until now.  For blocks too big for phase()."""
+    t = tracer
+    if t is not None:
+        t.span(name, t_start, time.time())
+
+def count(name, n=1):
+    t = tracer
+    if t is not None:
+        t.count(name, n)
+
+def sample(name, t_start, label=None):
+    """Record a latency for histogram *name*, from *t_start* until now."""
+    t = tracer
+    if t is not None:
+        t.sample(name, t_start, time.time(), label)
@@ -27,3 +27,7 @@ def posixjoin(a,*args):
         elif rhs=='': pass
         else: cur = '%s/%s' % (cur,rhs)
     return cur
+
+def shell_quote(s):
+    """Quote *s* as a single word for the android shell"""
+    return "'%s'" % s.replace("'", "'\\''")
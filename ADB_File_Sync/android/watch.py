@@ -0,0 +1,199 @@
+# -*- python -*-
+#
+# Copyright 2008 - 2015 Double Fine Productions
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#
+# Noticing changes to a local tree, for rsync.rsync_watch.
+#
+#   w = watch.watcher(root, scan)
+#   while True:
+#       for path in w.read(1.0):    # paths that may have changed, or root itself
+#           ...                     # if it's anyone's guess
+#   w.close()
+#
+# On Linux this uses inotify, through ctypes, with a watch on every directory.
+# Elsewhere it calls *scan* every so often and compares.  Either way a path
+# only says "look here": it may be a file or directory that was created,
+# changed or removed, and the caller has to stat it to find out which.
+#
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+
+from android.utils import posixjoin
+
+__all__ = ('InotifyWatcher', 'PollWatcher', 'watcher')
+
+POLL_INTERVAL = 1.0     # seconds between scans for PollWatcher
+
+_libc = None
+if sys.platform.startswith('linux'):
+    try:
+        import ctypes
+        import ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        _libc.inotify_init1
+        _libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+    except (ImportError, OSError, AttributeError):
+        _libc = None
+
+# See <sys/inotify.h>
+IN_ATTRIB       = 0x00000004
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DELETE_SELF  = 0x00000400
+IN_MOVE_SELF    = 0x00000800
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ONLYDIR      = 0x01000000
+IN_ISDIR        = 0x40000000
+IN_NONBLOCK     = 00004000
+IN_CLOEXEC      = 02000000
+
+# A file is looked at once it's been written and closed, not while it's
+# being written.  Created directories are looked at right away, so we can
+# watch them before anything lands in them.
+_WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+               IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len; followed by the name
+
+
+class InotifyWatcher(object):
+    """Reports changes under *root* as inotify sees them."""
+    def __init__(self, root):
+        self.root = root
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.dirs = {}          # watch descriptor -> directory
+        self._add_tree(root)
+
+    def _add_tree(self, top):
+        for (root, dirs, files) in os.walk(top):
+            root = root.replace(os.sep, '/')
+            wd = _libc.inotify_add_watch(self.fd, root, _WATCH_MASK)
+            if wd < 0:
+                e = ctypes.get_errno()
+                if e == errno.ENOSPC:
+                    raise OSError(e, "Out of inotify watches; raise fs.inotify.max_user_watches")
+                dirs[:] = []    # gone already, probably
+                continue
+            self.dirs[wd] = root
+
+    def read(self, timeout):
+        """Wait up to *timeout* seconds for something to change, and return the
+        set of paths that did.  The set is empty if nothing did."""
+        changed = set()
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR: raise
+            return changed
+        if not ready:
+            return changed
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR): break
+                raise
+            self._parse(data, changed)
+        return changed
+
+    def _parse(self, data, changed):
+        pos = 0
+        while pos < len(data):
+            (wd, mask, cookie, namelen) = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            name = data[pos:pos+namelen].rstrip('\0')
+            pos += namelen
+            if mask & IN_Q_OVERFLOW:
+                changed.add(self.root)      # lost track; look at everything
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            root = self.dirs.get(wd)
+            if root is None:
+                continue
+            if not name:
+                # A directory itself went away.  Its parent said so already,
+                # unless it's the root.
+                if root == self.root:
+                    changed.add(root)
+                continue
+            path = posixjoin(root, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_tree(path)
+            elif mask & IN_CREATE:
+                continue                    # wait for IN_CLOSE_WRITE
+            changed.add(path)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollWatcher(object):
+    """Reports changes by calling *scan* every *interval* seconds, and
+    comparing.  *scan* returns a dict mapping each file to anything that
+    changes when the file does, such as (size, mtime)."""
+    def __init__(self, scan, interval=POLL_INTERVAL):
+        self.scan = scan
+        self.interval = interval
+        self.files = scan()
+        self.t_next = time.time() + interval
+
+    def read(self, timeout):
+        """Wait up to *timeout* seconds for something to change, and return the
+        set of paths that did.  The set is empty if nothing did."""
+        t_end = time.time() + (timeout or 0)
+        while True:
+            t = time.time()
+            if t < self.t_next:
+                if t_end <= t:
+                    return set()
+                time.sleep(min(self.t_next, t_end) - t)
+                continue
+            files = self.scan()
+            self.t_next = time.time() + self.interval
+            old, self.files = self.files, files
+            changed = set(path for (path, v) in files.iteritems() if old.get(path) != v)
+            changed.update(path for path in old if path not in files)
+            if changed or t_end <= time.time():
+                return changed
+
+    def close(self):
+        pass
+
+
+def watcher(root, scan, interval=POLL_INTERVAL):
+    """Return an InotifyWatcher for *root* where there's inotify, and a
+    PollWatcher calling *scan* otherwise."""
+    if _libc is not None:
+        try:
+            return InotifyWatcher(root)
+        except OSError:
+            pass
+    return PollWatcher(scan, interval)
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+# -*- python -*-
+#
+# Copyright 2008 - 2015 Double Fine Productions
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#
+# Throughput benchmark for rsync(), against the fake adb server in
+# android.fakeadb, so no phone is needed.
+#
+# For each tree shape, times three runs: the initial copy, a no-op resync,
+# and a resync after changing a few files.  Reports files/s, MB/s and the
+# round trips the device saw.
+#
+#   python benchmark.py
+#   python benchmark.py --shape small --latency 0.002 --streams 4
+#   python benchmark.py --rsync-args "bundle_max_file=16384"
+#   python benchmark.py --shape mixed --trace out       # writes out-mixed-initial.json, .trace, ...
+#
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+from optparse import OptionParser
+
+from android import adb
+from android import rsync
+from android import trace
+from android.fakeadb import FakeDevice, FakeAdbServer, FEATURES
+
+REMOTE = '/sdcard/dfp/benchmark'
+
+# name -> list of (directory, size) for each file
+def _shape_small(rnd, scale):
+    return [('d%02d' % (i % 50), 2048) for i in xrange(int(5000 * scale))]
+
+def _shape_mixed(rnd, scale):
+    files = [('d%d/e%d' % (i % 10, i % 7), int(rnd.lognormvariate(9, 2)) % (1 << 20))
+             for i in xrange(int(1000 * scale))]
+    files.extend(('big', 5 << 20) for i in xrange(max(1, int(4 * scale))))
+    return files
+
+def _shape_large(rnd, scale):
+    return [('', 32 << 20) for i in xrange(max(1, int(4 * scale)))]
+
+def _shape_deep(rnd, scale):
+    return [('/'.join('n%d' % ((i >> k) % 3) for k in xrange(10)), 512)
+            for i in xrange(int(2000 * scale))]
+
+SHAPES = [
+    ('small', _shape_small),
+    ('mixed', _shape_mixed),
+    ('large', _shape_large),
+    ('deep',  _shape_deep),
+]
+
+
+def make_tree(root, files):
+    """Create *files* (from a shape) under *root*.  Returns the list of paths."""
+    paths = []
+    for (i, (subdir, size)) in enumerate(files):
+        folder = os.path.join(root, subdir)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        path = os.path.join(folder, 'f%05d.bin' % i)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(min(size, 1 << 16)) * (size >> 16) + os.urandom(size & 0xffff))
+        paths.append(path)
+    return paths
+
+def change_files(paths, fraction, rnd):
+    """Rewrite the first byte of some of *paths*.  Returns how many."""
+    changed = rnd.sample(paths, max(1, int(len(paths) * fraction)))
+    t = time.time() + 10
+    for path in changed:
+        with open(path, 'r+b') as f:
+            c = f.read(1)
+            f.seek(0)
+            f.write(chr((ord(c or '\0') + 1) % 256))
+        os.utime(path, (t, t))
+    return len(changed)
+
+
+def run_shape(name, shape, options, rsync_args):
+    rnd = random.Random(0)
+    tmp = tempfile.mkdtemp(prefix='adb_benchmark_')
+    try:
+        local = os.path.join(tmp, 'local')
+        paths = make_tree(local, shape(rnd, options.scale))
+        nbytes = sum(os.path.getsize(p) for p in paths)
+        fake = FakeDevice(os.path.join(tmp, 'device'),
+                          latency=options.latency,
+                          bandwidth=options.bandwidth * 1e6 if options.bandwidth else None,
+                          mtime_works=not options.mtime_broken,
+                          features=() if options.v1 else FEATURES)
+        server = FakeAdbServer([fake]).start()
+        adb.ADB_PORT = server.port
+        try:
+            device = adb.adb_get_devices()[0]
+            def _run(label, nfiles):
+                fake.reset_stats()
+                if options.trace: trace.start()
+                t = time.time()
+                rsync.rsync(device, local, REMOTE, report=lambda *args: None,
+                            warning=lambda w: sys.stderr.write("[WARNING] %s\n" % w),
+                            streams=options.streams, **rsync_args)
+                dt = time.time() - t
+                if options.trace:
+                    tracer = trace.stop()
+                    prefix = '%s-%s-%s' % (options.trace, name, label)
+                    tracer.write_json(prefix + '.json')
+                    tracer.write_chrome_trace(prefix + '.trace')
+                st = fake.stats
+                print "%-6s %-8s %8.3fs %9.1f files/s %8.2f MB/s %7d round trips %7d requests %4d conns" % (
+                    name, label, dt, nfiles / dt, st['bytes_in'] / dt / 1e6,
+                    st['round_trips'], st['requests'], st['connections'])
+            _run('initial', len(paths))
+            _run('noop', len(paths))
+            _run('changed', change_files(paths, 0.01, rnd))
+            device.close()
+        finally:
+            server.stop()
+        print "%-6s %d files, %.1f MB" % (name, len(paths), nbytes / 1e6)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--shape', action='append', choices=[n for (n, s) in SHAPES],
+                      help="tree shape to run (repeatable; default all)")
+    parser.add_option('--scale', type='float', default=1.0, help="multiply file counts by this")
+    parser.add_option('--latency', type='float', default=0.001, help="seconds per round trip")
+    parser.add_option('--bandwidth', type='float', default=40, help="MB/s each way; 0 for unlimited")
+    parser.add_option('--mtime-broken', action='store_true', help="device doesn't keep mtimes")
+    parser.add_option('--v1', action='store_true', help="device only speaks the v1 sync protocol")
+    parser.add_option('--streams', type='int', default=1, help="passed to rsync()")
+    parser.add_option('--rsync-args', default='', help="more rsync() keyword args, as python")
+    parser.add_option('--trace', metavar='PREFIX', help="write PREFIX-<shape>-<run>.json and .trace")
+    (options, args) = parser.parse_args()
+    rsync_args = eval('dict(%s)' % options.rsync_args)
+
+    for (name, shape) in SHAPES:
+        if options.shape is None or name in options.shape:
+            run_shape(name, shape, options, rsync_args)
+
+if __name__ == '__main__':
+    main()
@@ -33,12 +33,26 @@ def report_warning(warn):
     print("[WARNING] " + warn)
     
 def main():
+    LOCAL = 'example_data'
+    REMOTE = '/sdcard/adb_test'
+    if '--all' in sys.argv:
+        # Copy to every attached device at once
+        print("Synchronizing files to all devices.\nSource folder \"%s\" -> Destination folder \"%s\"\n" % (LOCAL, REMOTE))
+        results = rsync.rsync_many(adb.adb_get_devices(),
+            LOCAL, REMOTE,
+            warning=report_warning)
+        for serial, error in sorted(results.items()):
+            print("%s: %s" % (serial, error or "OK"))
+        return
+    if '--watch' in sys.argv:
+        # Push every change as it happens, until ^C
+        print("Watching \"%s\" -> Destination folder \"%s\"\n" % (LOCAL, REMOTE))
+        rsync.rsync_watch(get_device(), LOCAL, REMOTE, warning=report_warning)
+        return
     # Step 1: Create a device
     print("Creating ADB device\n")
     device = get_device()
     # Step 2: Copy some files to the attached device (if they have changed)
-    LOCAL = 'example_data'
-    REMOTE = '/sdcard/adb_test'
     print("Synchronizing files.\nSource folder \"%s\" -> Destination folder \"%s\"\n" % (LOCAL, REMOTE))
     rsync.rsync(device, 
         LOCAL, REMOTE,